@@ -0,0 +1,335 @@
+import os
+import csv
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import itertools
+import multiprocessing
+
+import libcsv2sqlite
+import dbutils
+
+
+# Every scenario overrides some of these
+DEFAULT_SCENARIO = {
+    'rows': 100000,
+    'columns': 8,
+    'types': ['int', 'float', 'text'],
+    'fk_columns': 1,
+    'fk_cardinality': 100,
+    'quoting': False,
+    'headers': True,
+    'seed': 42,
+}
+
+SCENARIOS = {
+    'narrow': {'columns': 4},
+    'wide': {'columns': 40, 'rows': 25000},
+    'fk_heavy': {'fk_columns': 4, 'fk_cardinality': 50000},
+    'quoted': {'quoting': True, 'types': ['text']},
+    'no_headers': {'headers': False},
+}
+
+STAGES = [
+    'csv_read_file',
+    'set_mapping_defaults',
+    'csv_transform',
+    'read_key_mappings',
+    'fk_mappings_to_database',
+    'patch_csv_data',
+    'insert_many',
+]
+
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel']
+
+
+def scenario_settings(name):
+    settings = dict(DEFAULT_SCENARIO)
+    settings.update(SCENARIOS[name])
+
+    return settings
+
+
+def column_kinds(settings):
+    # FK columns come first, the others cycle through the value types
+    kinds = ['fk'] * min(settings['fk_columns'], settings['columns'])
+    types = itertools.cycle(settings['types'])
+
+    while len(kinds) < settings['columns']:
+        kinds.append(next(types))
+
+    return kinds
+
+
+def generate_value(kind, rng, settings):
+    if kind == 'int':
+        return str(rng.randint(-1000000, 1000000))
+
+    if kind == 'float':
+        return '{:.4f}'.format(rng.uniform(-1000, 1000))
+
+    if kind == 'fk':
+        return 'value_{}'.format(rng.randrange(0, settings['fk_cardinality']))
+
+    text = ' '.join(rng.choice(WORDS) for i in range(0, rng.randint(1, 4)))
+
+    if settings['quoting'] and rng.random() < 0.3:
+        # Commas, quotes and newlines force the csv module to quote the value
+        text = '{}, "{}"\n{}'.format(text, rng.choice(WORDS), rng.choice(WORDS))
+
+    return text
+
+
+def generate_csv(csv_path, settings):
+    rng = random.Random(settings['seed'])
+    kinds = column_kinds(settings)
+
+    with open(csv_path, mode='w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+
+        if settings['headers']:
+            writer.writerow(['{}_{}'.format(kind, i) for i, kind in enumerate(kinds)])
+
+        for i in range(0, settings['rows']):
+            writer.writerow([generate_value(kind, rng, settings) for kind in kinds])
+
+
+def generate_mapping(mapping_path, settings):
+    mappings = []
+
+    for i, kind in enumerate(column_kinds(settings)):
+        mapping = {'csv_index': i}
+
+        if kind == 'fk':
+            mapping['key'] = 'fk'
+            mapping['column_name'] = 'reference_{}'.format(i)
+
+        mappings.append(mapping)
+
+    with open(mapping_path, 'w') as mapping_file:
+        json.dump({'table_name': 'benchmark', 'mappings': mappings}, mapping_file, indent=4)
+
+
+def peak_rss():
+    # Kilobytes on Linux, bytes on macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def time_stages(csv_path, mapping_path, db_path, settings):
+    timings = {}
+
+    def timed(stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        timings[stage] = time.perf_counter() - start
+        return result
+
+    _, _, mappings, action = libcsv2sqlite.load_and_process_mapping_config(mapping_path, 'benchmark', 'ignore')
+
+    all_csv_data = timed('csv_read_file', libcsv2sqlite.csv_read_file, csv_path)
+
+    headers = []
+
+    if settings['headers']:
+        headers = all_csv_data[0]
+        all_csv_data = all_csv_data[1:]
+
+    sample = all_csv_data[:libcsv2sqlite.TYPE_SAMPLE_SIZE]
+    timed('set_mapping_defaults', libcsv2sqlite.set_mapping_defaults, sample, mappings, headers, action)
+
+    dbutils.create_and_connect(db_path)
+    dbutils.create_table('benchmark', mappings)
+
+    all_csv_data = timed('csv_transform', libcsv2sqlite.csv_transform, all_csv_data, mappings)
+    fk_mappings, _ = timed('read_key_mappings', libcsv2sqlite.read_key_mappings, all_csv_data, mappings)
+    fk_patch_data = timed('fk_mappings_to_database', libcsv2sqlite.fk_mappings_to_database, fk_mappings)
+    all_csv_data = timed('patch_csv_data', libcsv2sqlite.patch_csv_data, fk_patch_data, all_csv_data)
+
+    keys = [libcsv2sqlite.table_column_name(mapping) for mapping in mappings]
+    timed('insert_many', dbutils.insert_many, 'benchmark', keys, all_csv_data)
+
+    dbutils.connection.close()
+    dbutils.delete_database(db_path)
+
+    return timings
+
+
+def time_end_to_end(csv_path, mapping_path, db_path, settings, options):
+    args = argparse.Namespace(
+        input=csv_path,
+        mapping=mapping_path,
+        output=db_path,
+        default_mapping_action='ignore',
+        csv_has_title_columns=settings['headers'],
+        **options
+    )
+
+    importer = libcsv2sqlite.Importer(args)
+
+    start = time.perf_counter()
+    importer.run()
+    elapsed = time.perf_counter() - start
+
+    importer.close()
+    dbutils.delete_database(db_path)
+
+    return elapsed
+
+
+def run_measurement(queue, function, *args):
+    # Runs in a fresh process so peak RSS belongs to this measurement only
+    result = function(*args)
+    queue.put((result, peak_rss()))
+
+
+def measure(function, *args):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_measurement, args=(queue, function) + args)
+    process.start()
+    result = queue.get()
+    process.join()
+
+    return result
+
+
+def run_scenario(name, work_dir, options):
+    settings = scenario_settings(name)
+
+    csv_path = os.path.join(work_dir, 'benchmark_{}.csv'.format(name))
+    mapping_path = os.path.join(work_dir, 'benchmark_{}.json'.format(name))
+    db_path = os.path.join(work_dir, 'benchmark_{}.sqlite3'.format(name))
+
+    generate_csv(csv_path, settings)
+    generate_mapping(mapping_path, settings)
+
+    csv_bytes = os.path.getsize(csv_path)
+    rows = settings['rows']
+
+    timings, stages_rss = measure(time_stages, csv_path, mapping_path, db_path, settings)
+    elapsed, end_to_end_rss = measure(time_end_to_end, csv_path, mapping_path, db_path, settings, options)
+
+    os.remove(csv_path)
+    os.remove(mapping_path)
+
+    result = {'rows': rows, 'bytes': csv_bytes, 'stages': {}}
+
+    for stage in STAGES:
+        seconds = timings[stage]
+        result['stages'][stage] = {
+            'seconds': seconds,
+            'rows_per_second': rows / seconds if seconds else None,
+        }
+
+    result['end_to_end'] = {
+        'seconds': elapsed,
+        'rows_per_second': rows / elapsed,
+        'megabytes_per_second': csv_bytes / elapsed / 1024 / 1024,
+        'peak_rss_kb': end_to_end_rss,
+    }
+    result['stages_peak_rss_kb'] = stages_rss
+
+    return result
+
+
+def format_rate(rate):
+    return '{:>12,.0f}'.format(rate) if rate else '{:>12}'.format('-')
+
+
+def print_results(results):
+    for name, result in results.items():
+        end_to_end = result['end_to_end']
+
+        print('{} ({:,} rows, {:.1f} MB)'.format(name, result['rows'], result['bytes'] / 1024 / 1024))
+
+        for stage in STAGES:
+            stats = result['stages'][stage]
+            print('  {:<26}{:>9.3f} s{} rows/s'.format(stage, stats['seconds'], format_rate(stats['rows_per_second'])))
+
+        print('  {:<26}{:>9.3f} s{} rows/s {:>8.1f} MB/s {:>10,} KB peak RSS'.format(
+            'end to end', end_to_end['seconds'], format_rate(end_to_end['rows_per_second']),
+            end_to_end['megabytes_per_second'], end_to_end['peak_rss_kb']))
+        print('')
+
+
+def compare(results, baseline, tolerance):
+    # Returns a list of (scenario, measurement, change) for slower measurements
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        measurements = [(stage, result['stages'][stage], baseline[name]['stages'].get(stage)) for stage in STAGES]
+        measurements.append(('end to end', result['end_to_end'], baseline[name]['end_to_end']))
+
+        for measurement, current, previous in measurements:
+            if not previous or not previous['seconds']:
+                continue
+
+            change = current['seconds'] / previous['seconds'] - 1
+
+            if change > tolerance:
+                regressions.append((name, measurement, change))
+
+        rss_change = result['end_to_end']['peak_rss_kb'] / baseline[name]['end_to_end']['peak_rss_kb'] - 1
+
+        if rss_change > tolerance:
+            regressions.append((name, 'peak RSS', rss_change))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark csv2sqlite on generated CSV files.')
+
+    parser.add_argument('--scenario', '-s', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, may be repeated. Runs every scenario by default')
+    parser.add_argument('--rows', '-r', type=int, help='override the number of rows of every scenario')
+    parser.add_argument('--work-dir', default='tmp', help='where generated files are written')
+    parser.add_argument('--output', '-o', metavar='results.json', help='write results as JSON')
+    parser.add_argument('--baseline', metavar='baseline.json', help='compare against results saved with --output')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='slowdown relative to the baseline reported as a regression (default 0.10)')
+    parser.add_argument('--batch-size', type=int, default=10000, help='batch size of the end to end import')
+    parser.add_argument('--workers', type=int, default=1, help='workers of the end to end import')
+
+    my_args = parser.parse_args()
+
+    os.makedirs(my_args.work_dir, exist_ok=True)
+
+    if my_args.rows:
+        for scenario in SCENARIOS.values():
+            scenario['rows'] = my_args.rows
+
+    options = {'batch_size': my_args.batch_size, 'workers': my_args.workers}
+    results = {}
+
+    for name in my_args.scenario or sorted(SCENARIOS):
+        results[name] = run_scenario(name, my_args.work_dir, options)
+
+    print_results(results)
+
+    if my_args.output:
+        with open(my_args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
+
+    if my_args.baseline:
+        with open(my_args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), my_args.tolerance)
+
+        for name, measurement, change in regressions:
+            print('REGRESSION {} / {}: {:+.0%}'.format(name, measurement, change))
+
+        if regressions:
+            exit(1)
+
+        print('No regressions against {}'.format(my_args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import argparse
 import libcsv2sqlite
+import service
 
 
 parser = argparse.ArgumentParser(
@@ -12,8 +13,9 @@ required_named.add_argument(
     '--input', '-i',
     metavar='data.csv',
     type=str,
-    help='path of the source CSV file',
-    required=True
+    nargs='+',
+    help='paths of the source CSV files, optionally compressed with gzip, bz2, xz or zip. Glob patterns and directories are expanded, every file is imported into the same table. Not used with --spool-dir or --socket',
+    required=False
 )
 
 parser.add_argument(
@@ -50,4 +52,218 @@ parser.add_argument(
     choices=['import', 'ignore']
 )
 
-libcsv2sqlite.csv_to_sqlite3(parser.parse_args())
+parser.add_argument(
+    '--batch-size', '-b',
+    metavar='N',
+    help='number of CSV rows transformed and inserted at a time. Bigger batches are faster but use more memory',
+    type=int,
+    required=False,
+    default=10000
+)
+
+parser.add_argument(
+    '--workers', '-w',
+    metavar='N',
+    help='number of processes parsing and transforming the CSV file in parallel, 0 uses every core. Compressed files are always read by a single process',
+    type=int,
+    required=False,
+    default=1
+)
+
+parser.add_argument(
+    '--profile', '-p',
+    help='SQLite settings used while loading. "fast" and "unsafe" trade durability during the import for speed, a crash may corrupt the database (unsafe) or lose the last batches (fast)',
+    type=str,
+    required=False,
+    default='safe',
+    choices=['safe', 'fast', 'unsafe']
+)
+
+parser.add_argument(
+    '--defer-indexes',
+    help='create new tables without their primary key and build it as a unique index after loading, when --on-conflict or the insert_mode of the key says which row of a duplicated key to keep. Without one the key is created with the table and duplicates are rejected',
+    action='store_true',
+    required=False,
+    default=False
+)
+
+parser.add_argument(
+    '--no-fk-indexes',
+    help='do not index the generated *_id columns of foreign keys',
+    dest='fk_indexes',
+    action='store_false',
+    required=False,
+    default=True
+)
+
+parser.add_argument(
+    '--type-sample',
+    help='rows used to guess column types: the first rows (head), rows spread over the whole file (stride) or every row (full). stride and full read the file twice',
+    type=str,
+    required=False,
+    default='head',
+    choices=['head', 'stride', 'full']
+)
+
+parser.add_argument(
+    '--type-sample-size',
+    metavar='N',
+    help='number of rows used to guess column types with the head and stride samples',
+    type=int,
+    required=False,
+    default=1000
+)
+
+parser.add_argument(
+    '--schema-cache',
+    help='store guessed column types in a .csv2sqlite-schema.json file next to the CSV file, keyed by its title columns, and reuse them in later imports',
+    action='store_true',
+    required=False,
+    default=False
+)
+
+parser.add_argument(
+    '--mapping-cache',
+    help='store the resolved mappings (column indices, names, types and transformations) in a .csv2sqlite-mappings.json file next to the CSV file and reuse them while the mapping file, the transformations file and the title columns are unchanged',
+    action='store_true',
+    required=False,
+    default=False
+)
+
+parser.add_argument(
+    '--stats',
+    help='print time, CPU time, throughput and SQLite activity of every import stage',
+    action='store_true',
+    required=False,
+    default=False
+)
+
+parser.add_argument(
+    '--stats-json',
+    metavar='stats.json',
+    help='write the import statistics to a JSON file',
+    type=str,
+    required=False,
+    default=None
+)
+
+parser.add_argument(
+    '--incremental',
+    help='only import rows appended since the last import of the same file into the same table, and resume interrupted imports. Progress is stored in the csv2sqlite_checkpoints table',
+    action='store_true',
+    required=False,
+    default=False
+)
+
+parser.add_argument(
+    '--on-conflict',
+    help='what to do with rows whose primary key already exists, in the table or earlier in the file: keep the existing row (ignore), delete it and insert the new one (replace) or update its columns (update). Defaults to the "insert_mode" of the mapped primary key',
+    type=str,
+    required=False,
+    default=None,
+    choices=['ignore', 'replace', 'update']
+)
+
+parser.add_argument(
+    '--max-errors',
+    help='abort the import once more records than this were rejected by the database. By default every rejected record is skipped',
+    type=int,
+    required=False,
+    default=None
+)
+
+parser.add_argument(
+    '--reject-file',
+    help='CSV file receiving rejected records, as transformed, with their file, line number and error. Defaults to the output file name with a .rejects.csv extension',
+    type=str,
+    required=False,
+    default=None
+)
+
+parser.add_argument(
+    '--build-in-memory',
+    help='build the database in memory and write it to the output file in one pass, replacing it atomically. "auto" does it when the input is small enough for the available memory',
+    type=str,
+    required=False,
+    nargs='?',
+    const='always',
+    default='never',
+    choices=['always', 'auto', 'never']
+)
+
+parser.add_argument(
+    '--fk-engine',
+    help='how foreign key values are replaced by ids: in Python with a value -> id dictionary, or inside SQLite through a staging table (sql), keeping memory flat for columns with many distinct values',
+    type=str,
+    required=False,
+    default='python',
+    choices=['python', 'sql']
+)
+
+parser.add_argument(
+    '--fk-max-memory',
+    help='memory in MB for foreign key value -> id pairs. Only the most recently used pairs are kept, the others are looked up in the reference tables. By default every pair is kept',
+    type=float,
+    required=False,
+    default=None
+)
+
+parser.add_argument(
+    '--queue-size',
+    metavar='N',
+    help='number of transformed batches a reader thread may prepare while the previous ones are written. The reader waits when the queue is full. 0 reads and writes in turn',
+    type=int,
+    required=False,
+    default=0
+)
+
+parser.add_argument(
+    '--shards',
+    metavar='N',
+    help='number of worker processes writing their own temporary databases, merged into the output at the end. Up to 10 shards, 0 writes through a single connection',
+    type=int,
+    required=False,
+    default=0
+)
+
+parser.add_argument(
+    '--progress',
+    help='show the share of the input read, rows/s, MB/s, the current stage and the remaining time on stderr. A terminal gets one line updated twice a second, other outputs a line every 10 seconds',
+    action='store_true',
+    required=False,
+    default=False
+)
+
+parser.add_argument(
+    '--spool-dir',
+    metavar='DIR',
+    help='run as a service importing every CSV file that appears in DIR with the other options, then moving it to DIR/done or DIR/failed. Files should be written under a name starting with a dot and renamed once complete',
+    required=False,
+    default=None
+)
+
+parser.add_argument(
+    '--socket',
+    metavar='PATH',
+    help='run as a service accepting jobs on a Unix socket, one JSON object of options per line ({"input": [...], "output": ...}) answered with the result, or {"command": "status"} for the queue depth and job latencies',
+    required=False,
+    default=None
+)
+
+parser.add_argument(
+    '--service-workers',
+    metavar='N',
+    help='number of threads importing service jobs. Each database is always imported by the same thread, which keeps its connection, mappings and foreign key ids between jobs',
+    type=int,
+    required=False,
+    default=1
+)
+
+my_args = parser.parse_args()
+
+if my_args.spool_dir or my_args.socket:
+    service.serve(my_args)
+elif my_args.input:
+    libcsv2sqlite.csv_to_sqlite3(my_args)
+else:
+    parser.error('the following arguments are required: --input/-i')
@@ -1,31 +1,239 @@
 import sqlite3
+import datetime
+import itertools
+import heapq
 import os
+import shutil
 
 
 connection = None
 
+# PRAGMA settings used while loading data. page_size only applies to new databases
+PROFILES = {
+    'safe': [
+        ('cache_size', -65536),
+        ('temp_store', 'MEMORY'),
+    ],
+    'fast': [
+        ('page_size', 65536),
+        ('locking_mode', 'EXCLUSIVE'),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -262144),
+        ('temp_store', 'MEMORY'),
+    ],
+    'unsafe': [
+        ('page_size', 65536),
+        ('locking_mode', 'EXCLUSIVE'),
+        ('journal_mode', 'OFF'),
+        ('synchronous', 'OFF'),
+        ('cache_size', -524288),
+        ('temp_store', 'MEMORY'),
+    ],
+}
+
+# Settings read by start_load and put back by finish_load, other connections must
+# see the database as it was. An exclusive lock taken in WAL mode is only given
+# up once the journal mode changed, locking_mode goes first and last
+NORMAL_SETTINGS = ['locking_mode', 'journal_mode', 'synchronous', 'locking_mode']
+
+
+class CountingCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        self.connection.statements += 1
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.connection.statements += 1
+        result = super().executemany(sql, seq_of_parameters)
+        self.connection.rows_written += max(self.rowcount, 0)
+        return result
+
+
+class CountingConnection(sqlite3.Connection):
+    # Keeps statement, written row and commit counts for import statistics
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = 0
+        self.rows_written = 0
+        self.commits = 0
+        self.normal_settings = {}
+        self.loading = False
+
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+    def commit(self):
+        self.commits += 1
+        super().commit()
+
 
 def python_to_sqlite_type(python_type):
     sqlite_types = {
         int: 'INTEGER',
         float: 'REAL',
-        str: 'TEXT'
+        str: 'TEXT',
+        bool: 'BOOLEAN',
+        datetime.date: 'DATE',
+        datetime.datetime: 'DATETIME'
     }
 
     return sqlite_types[python_type]
 
 
-def create_and_connect(db_path):
+def connect(db_path, profile='safe'):
+    is_new = db_path == ':memory:' or not os.path.exists(db_path) or os.path.getsize(db_path) == 0
+
+    # Owned by a single thread, like the Importer that opens it
+    db = sqlite3.connect(db_path, factory=CountingConnection)
+    start_load(profile, is_new, db)
+
+    return db
+
+
+def start_load(profile='safe', is_new=False, db=None):
+    # Also prepares connections kept open since the previous finish_load,
+    # their counts start again with every import
+    db = resolve(db)
+    db.statements = db.rows_written = db.commits = 0
+    db.normal_settings = dict((name, get_pragma(name, db)) for name in NORMAL_SETTINGS)
+    db.loading = True
+
+    for name, value in PROFILES[profile]:
+        if name == 'page_size' and not is_new:
+            continue
+
+        set_pragma(name, value, db)
+
+
+def connect_in_memory(db_path, profile='safe'):
+    # Loads into a copy of db_path held in memory, written back by save_to_disk
+    db = connect(':memory:', profile)
+
+    # Given to the file save_to_disk writes, a memory database has no journal of its own
+    db.normal_settings['journal_mode'] = 'delete'
+
+    if os.path.exists(db_path) and os.path.getsize(db_path) > 0:
+        source = sqlite3.connect(db_path)
+
+        # Folds a WAL back into the file, it must not outlive the database it belongs to
+        source.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        db.normal_settings['journal_mode'] = get_pragma('journal_mode', source)
+        source.backup(db)
+        source.close()
+
+    return db
+
+
+def save_to_disk(db, db_path):
+    # Written next to db_path, then swapped in: readers see the old or the new database
+    temp_path = db_path + '.csv2sqlite-tmp'
+
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    try:
+        disk = sqlite3.connect(temp_path)
+        db.backup(disk)
+        set_pragma('journal_mode', db.normal_settings['journal_mode'], disk)
+        disk.close()
+
+        if os.path.exists(db_path):
+            shutil.copymode(db_path, temp_path)
+
+        os.replace(temp_path, db_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        raise
+
+    db.close()
+
+    return sqlite3.connect(db_path, factory=CountingConnection)
+
+
+def create_and_connect(db_path, profile='safe'):
     global connection
-    connection = sqlite3.connect(db_path)
+
+    connection = connect(db_path, profile)
+
+
+def resolve(db):
+    # Every function works on an explicit connection when given one
+    return connection if db is None else db
+
+
+def set_pragma(name, value, db=None):
+    db = resolve(db)
+
+    cursor = db.cursor()
+
+    cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.fetchall()
+
+    cursor.close()
+
+
+def counters(db=None):
+    db = resolve(db)
+
+    return {
+        'statements': db.statements,
+        'rows_written': db.rows_written,
+        'commits': db.commits,
+    }
+
+
+def get_pragma(name, db=None):
+    db = resolve(db)
+
+    cursor = db.cursor()
+
+    cursor.execute('PRAGMA {}'.format(name))
+    results = cursor.fetchone()
+
+    cursor.close()
+
+    return results[0]
+
+
+def finish_load(db=None):
+    db = resolve(db)
+
+    db.commit()
+    restore_settings(db)
+
+
+def abort_load(db=None):
+    # After a failed import the database still gets its own settings back
+    db = resolve(db)
+
+    if db.loading:
+        db.rollback()
+        restore_settings(db)
+
+
+def restore_settings(db=None):
+    db = resolve(db)
+
+    for name in NORMAL_SETTINGS:
+        set_pragma(name, db.normal_settings[name], db)
+
+    # A lock left by locking_mode = EXCLUSIVE is only given up on the next access
+    get_pragma('schema_version', db)
+    db.loading = False
 
 
 def delete_database(db_path):
     os.remove(db_path)
 
 
-def table_exists(table_name):
-    cursor = connection.cursor()
+def table_exists(table_name, db=None):
+    db = resolve(db)
+
+    cursor = db.cursor()
 
     cursor.execute("SELECT * FROM sqlite_master WHERE name=? and type='table'", (table_name,))
     results = cursor.fetchone()
@@ -35,8 +243,10 @@ def table_exists(table_name):
     return results != None
 
 
-def column_exists(table_name, column_name):
-    cursor = connection.cursor()
+def column_exists(table_name, column_name, db=None):
+    db = resolve(db)
+
+    cursor = db.cursor()
 
     cursor.execute("PRAGMA table_info('{}')".format(table_name))
     results = cursor.fetchall()
@@ -50,8 +260,10 @@ def column_exists(table_name, column_name):
     return False
 
 
-def column_is_pk(table_name, column_name):
-    cursor = connection.cursor()
+def column_is_pk(table_name, column_name, db=None):
+    db = resolve(db)
+
+    cursor = db.cursor()
 
     cursor.execute("PRAGMA table_info('{}')".format(table_name))
     results = cursor.fetchall()
@@ -64,8 +276,10 @@ def column_is_pk(table_name, column_name):
 
     return False
 
-def create_table(table_name, mappings=[]):
-    if table_exists(table_name):
+def create_table(table_name, mappings=[], defer_pk=False, db=None):
+    db = resolve(db)
+
+    if table_exists(table_name, db):
         return False
 
     all_columns = []
@@ -82,9 +296,10 @@ def create_table(table_name, mappings=[]):
                 create_table(column_name, [{
                     'column_name': 'value',
                     'data_type': data_type
-                }])
+                }], db=db)
                 fk_key_columns.append(column_name)
                 column_name = column_name + '_id'
+                data_type = 'INTEGER'
             else:
                 pk_key_columns.append(column_name)
 
@@ -105,28 +320,183 @@ def create_table(table_name, mappings=[]):
     if len(fk_key_columns_str) > 0:
         fk_key_columns_str = ', ' + fk_key_columns_str
 
-    query = 'CREATE TABLE {} ({}, PRIMARY KEY ({}) {})'.format(
-        table_name, all_columns_str, pk_key_columns_str, fk_key_columns_str)
+    if defer_pk and pk_key_columns != ['id']:
+        # Rows are appended in rowid order, the key is built later by create_indexes
+        query = 'CREATE TABLE {} ({} {})'.format(
+            table_name, all_columns_str, fk_key_columns_str)
+    else:
+        query = 'CREATE TABLE {} ({}, PRIMARY KEY ({}) {})'.format(
+            table_name, all_columns_str, pk_key_columns_str, fk_key_columns_str)
 
-    cursor = connection.cursor()
+    cursor = db.cursor()
     cursor.execute(query)
     cursor.close()
 
     return True
 
 
-def insert(table_name, records):
+def index_name(table_name, columns, unique=False):
+    return '{}_{}_{}'.format('ux' if unique else 'ix', table_name, '_'.join(columns))
+
+
+def create_indexes(table_name, indexes, db=None):
+    db = resolve(db)
+
+    cursor = db.cursor()
+    deleted = 0
+
+    for index in indexes:
+        columns = index['columns']
+        unique = index.get('unique', False)
+
+        # Only a key built after loading under a conflict mode says which duplicate to keep,
+        # the first (or last) row of every key, like ignored (or replaced) inserts would.
+        # Other unique indexes fail on duplicates instead of losing rows
+        if 'keep' in index:
+            cursor.execute('DELETE FROM {0} WHERE rowid NOT IN (SELECT {2}(rowid) FROM {0} GROUP BY {1})'.format(
+                table_name, ', '.join(columns), 'MAX' if index['keep'] == 'last' else 'MIN'))
+            deleted += max(cursor.rowcount, 0)
+
+        cursor.execute('CREATE {}INDEX IF NOT EXISTS {} ON {} ({})'.format(
+            'UNIQUE ' if unique else '', index_name(table_name, columns, unique),
+            table_name, ', '.join(columns)))
+
+    db.commit()
+    cursor.close()
+
+    return deleted
+
+
+def list_indexes(table_name, db=None):
+    db = resolve(db)
+
+    cursor = db.cursor()
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='index' and tbl_name=?", (table_name,))
+    results = cursor.fetchall()
+
+    cursor.close()
+
+    return [result[0] for result in results]
+
+
+CHECKPOINT_TABLE = 'csv2sqlite_checkpoints'
+
+
+def create_checkpoint_table(db=None):
+    db = resolve(db)
+
+    cursor = db.cursor()
+
+    cursor.execute('CREATE TABLE IF NOT EXISTS {} ('
+                   'source TEXT, table_name TEXT, byte_offset INTEGER, row_count INTEGER, '
+                   'fingerprint TEXT, updated_at TEXT, PRIMARY KEY (source, table_name))'.format(CHECKPOINT_TABLE))
+
+    cursor.close()
+
+
+def get_checkpoint(source, table_name, db=None):
+    db = resolve(db)
+
+    create_checkpoint_table(db)
+
+    cursor = db.cursor()
+
+    cursor.execute('SELECT byte_offset, row_count, fingerprint FROM {} WHERE source=? and table_name=?'.format(
+        CHECKPOINT_TABLE), (source, table_name))
+    results = cursor.fetchone()
+
+    cursor.close()
+
+    if results is None:
+        return None
+
+    return {'byte_offset': results[0], 'row_count': results[1], 'fingerprint': results[2]}
+
+
+def save_checkpoint(source, table_name, byte_offset, row_count, fingerprint, db=None):
+    # Not committed here, the checkpoint is committed together with its rows
+    db = resolve(db)
+
+    cursor = db.cursor()
+
+    cursor.execute("INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?, ?, datetime('now'))".format(CHECKPOINT_TABLE),
+                   (source, table_name, byte_offset, row_count, fingerprint))
+
+    cursor.close()
+
+
+CONFLICT_VERBS = {
+    'ignore': 'INSERT OR IGNORE',
+    'replace': 'INSERT OR REPLACE',
+}
+
+# Errors caused by the values of a single record
+ROW_ERRORS = (
+    sqlite3.IntegrityError,
+    sqlite3.InterfaceError,
+    sqlite3.ProgrammingError,
+    OverflowError,
+)
+
+# Maximum number of keys bound to a single query
+KEYS_PER_QUERY = 500
+
+
+def upsert_clause(keys, conflict_keys):
+    if not conflict_keys:
+        return ''
+
+    updates = ['{0}=excluded.{0}'.format(key) for key in keys if key not in conflict_keys]
+
+    return ' ON CONFLICT ({}) DO {}'.format(
+        ', '.join(conflict_keys), 'UPDATE SET ' + ', '.join(updates) if updates else 'NOTHING')
+
+
+def count_existing(table_name, columns, keys, db=None):
+    # Number of the given key tuples already present in the table
+    db = resolve(db)
+
+    keys = list(keys)
+    found = 0
+
+    cursor = db.cursor()
+
+    for i in range(0, len(keys), KEYS_PER_QUERY):
+        batch = keys[i:i + KEYS_PER_QUERY]
+
+        if len(columns) == 1:
+            query = 'SELECT COUNT(*) FROM {} WHERE {} IN ({})'.format(
+                table_name, columns[0], ', '.join(['?'] * len(batch)))
+            parameters = [key[0] for key in batch]
+        else:
+            row_marks = '({})'.format(', '.join(['?'] * len(columns)))
+            query = 'SELECT COUNT(*) FROM {} WHERE ({}) IN (VALUES {})'.format(
+                table_name, ', '.join(columns), ', '.join([row_marks] * len(batch)))
+            parameters = [value for key in batch for value in key]
+
+        cursor.execute(query, parameters)
+        found += cursor.fetchone()[0]
+
+    cursor.close()
+
+    return found
+
+
+def insert(table_name, records, db=None):
+    db = resolve(db)
+
     formatted_keys = ', '.join(["'{}'".format(val) for val in records.keys()])
     formatted_values = ', '.join(["'{}'".format(val) for val in records.values()])
 
     query = 'INSERT INTO {} ({}) VALUES ({})'.format(
         table_name, formatted_keys, formatted_values)
 
-    cursor = connection.cursor()
+    cursor = db.cursor()
 
     try:
         cursor.execute(query)
-        connection.commit()
+        db.commit()
         success = True
     except sqlite3.IntegrityError:
         success = False
@@ -136,32 +506,334 @@ def insert(table_name, records):
     return success
 
 
-def insert_many(table_name, keys, records):
+def insert_many(table_name, keys, records, on_conflict=None, conflict_keys=None, db=None):
+    # Returns (position, error) for every record the database refused
+    db = resolve(db)
+
     if not len(records):
-        return True
+        return []
 
     formatted_keys = ', '.join(["'{}'".format(key) for key in keys])
     question_marks = ', '.join(['?' for i in range(0, len(keys))])
 
-    query = 'INSERT INTO {} ({}) VALUES ({})'.format(
-        table_name, formatted_keys, question_marks)
+    query = '{} INTO {} ({}) VALUES ({}){}'.format(
+        CONFLICT_VERBS.get(on_conflict, 'INSERT'), table_name, formatted_keys, question_marks,
+        upsert_clause(keys, conflict_keys) if on_conflict == 'update' else '')
 
-    cursor = connection.cursor()
+    cursor = db.cursor()
+    rejected = []
+    position = [0]
 
-    try:
-        cursor.executemany(query, records)
-        connection.commit()
-        success = True
-    except sqlite3.IntegrityError:
-        success = False
+    while position[0] < len(records):
+        try:
+            cursor.executemany(query, tracked_records(records, position))
+        except ROW_ERRORS as ex:
+            # executemany stops at the bad record, the ones before it are written
+            rejected.append((position[0], str(ex)))
+            position[0] += 1
 
+    db.commit()
     cursor.close()
 
-    return success
+    return rejected
+
+
+def tracked_records(records, position):
+    # Leaves the index of the record being written in position[0]
+    for i in range(position[0], len(records)):
+        position[0] = i
+        yield records[i]
+
+    position[0] = len(records)
+
+
+def staging_columns(column_count):
+    return ['c{}'.format(i) for i in range(0, column_count)]
+
+
+def load_staging(staging_name, records, fk_tables, db=None):
+    # Loads records into an empty temporary table and adds their new values to
+    # the reference tables. Returns the records the staging table refused
+    db = resolve(db)
+
+    if not len(records):
+        return []
+
+    columns = staging_columns(len(records[0]))
+
+    cursor = db.cursor()
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS {} ({})'.format(staging_name, ', '.join(columns)))
+    cursor.execute('DELETE FROM {}'.format(staging_name))
+
+    rejected = insert_many(staging_name, columns, records, db=db)
+
+    for position, fk_table in fk_tables.items():
+        # Reference values are unique, so new ones are inserted by SQLite directly
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} (value)'.format(
+            index_name(fk_table, ['value'], True), fk_table))
+        cursor.execute('INSERT OR IGNORE INTO {0} (value) SELECT DISTINCT {1} FROM {2} WHERE {1} IS NOT NULL'.format(
+            fk_table, columns[position], staging_name))
 
+    db.commit()
+    cursor.close()
+
+    return rejected
+
+
+def staging_select(staging_name, column_count, fk_tables):
+    # Staged rows in their original order, fk values replaced by reference ids
+    columns = staging_columns(column_count)
+    expressions = []
+    joins = []
+
+    for i, column in enumerate(columns):
+        if i in fk_tables:
+            expressions.append('f{}.id'.format(i))
+            joins.append('LEFT JOIN {0} AS f{1} ON f{1}.value = s.{2}'.format(fk_tables[i], i, column))
+        else:
+            expressions.append('s.' + column)
+
+    # WHERE keeps the ON of the joins apart from an upsert clause
+    return 'SELECT {} FROM {} AS s {} WHERE 1 ORDER BY s.rowid'.format(
+        ', '.join(expressions), staging_name, ' '.join(joins))
+
+
+def can_roll_back(db=None):
+    # Without a journal a failed statement keeps the rows it wrote before the
+    # error, only row by row inserts can tell which ones made it
+    return get_pragma('journal_mode', db).lower() != 'off'
+
+
+def insert_from_staging(table_name, keys, staging_name, fk_tables, on_conflict=None, conflict_keys=None, db=None):
+    # One INSERT ... SELECT for the whole batch. If a record breaks it, or the
+    # journal is off, the batch is read back and written by insert_many
+    db = resolve(db)
+
+    formatted_keys = ', '.join(["'{}'".format(key) for key in keys])
+    select = staging_select(staging_name, len(keys), fk_tables)
+
+    query = '{} INTO {} ({}) {}{}'.format(
+        CONFLICT_VERBS.get(on_conflict, 'INSERT'), table_name, formatted_keys, select,
+        upsert_clause(keys, conflict_keys) if on_conflict == 'update' else '')
+
+    cursor = db.cursor()
+
+    if can_roll_back(db):
+        try:
+            cursor.execute(query)
+        except ROW_ERRORS:
+            pass
+        else:
+            db.rows_written += max(cursor.rowcount, 0)
+            db.commit()
+            cursor.close()
+            return []
+
+    cursor.execute(select)
+    records = cursor.fetchall()
+    cursor.close()
+
+    return insert_many(table_name, keys, records, on_conflict, conflict_keys, db)
+
+
+def attach(db_path, schema, db=None):
+    db = resolve(db)
+    db.execute('ATTACH DATABASE ? AS {}'.format(schema), (db_path,))
+
+    # Attached databases start with the default 2 MB cache
+    set_pragma(schema + '.cache_size', get_pragma('cache_size', db), db)
+
+
+def max_attached(db=None):
+    return resolve(db).getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+
+
+def detach(schema, db=None):
+    db = resolve(db)
+
+    # A failed statement leaves its transaction open, which keeps attached databases
+    if db.in_transaction:
+        db.rollback()
+
+    db.execute('DETACH DATABASE {}'.format(schema))
+
+
+def merge_references(table_name, schemas, db=None):
+    # Adds the values of an attached reference table that the main one lacks
+    db = resolve(db)
+
+    cursor = db.cursor()
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS main.{} ON {} (value)'.format(
+        index_name(table_name, ['value'], True), table_name))
+
+    for schema in schemas:
+        cursor.execute('INSERT OR IGNORE INTO main.{0} (value) SELECT value FROM {1}.{0} ORDER BY id'.format(
+            table_name, schema))
+
+    db.commit()
+    cursor.close()
 
-def count(table_name):
-    cursor = connection.cursor()
+
+def id_map_name(schema, position):
+    return 'csv2sqlite_ids_{}_{}'.format(schema, position)
+
+
+def shard_select(table_name, keys, fk_tables, schemas, source=False, with_order=False, where='1'):
+    # Rows of every attached shard in rowid order. Reference ids of a shard are
+    # replaced through the maps of merge_shards, or by the values themselves for
+    # the source form. with_order adds the rowid in front of every row
+    arms = []
+
+    for schema in schemas:
+        expressions = ['t.rowid AS csv2sqlite_order']
+        joins = []
+
+        for i, key in enumerate(keys):
+            if i in fk_tables and source:
+                expressions.append('g{0}.value AS k{0}'.format(i))
+                joins.append('LEFT JOIN {0}.{1} AS g{2} ON g{2}.id = t.{3}'.format(schema, fk_tables[i], i, key))
+            elif i in fk_tables:
+                expressions.append('g{0}.main_id AS k{0}'.format(i))
+                joins.append('LEFT JOIN temp.{0} AS g{1} ON g{1}.shard_id = t.{2}'.format(id_map_name(schema, i), i, key))
+            else:
+                expressions.append('t.{} AS k{}'.format(key, i))
+
+        arms.append('SELECT {} FROM {}.{} AS t {}'.format(', '.join(expressions), schema, table_name, ' '.join(joins)))
+
+    columns = ['k{}'.format(i) for i in range(0, len(keys))]
+
+    if with_order:
+        columns.insert(0, 'csv2sqlite_order')
+
+    # WHERE keeps the ORDER BY apart from an upsert clause
+    return 'SELECT {} FROM ({}) WHERE {} ORDER BY csv2sqlite_order'.format(
+        ', '.join(columns), ' UNION ALL '.join(arms), where)
+
+
+def shard_rows(n, rows):
+    # Puts the shard number after the rowid of every row
+    for row in rows:
+        yield (row[0], n) + row[1:]
+
+
+def merge_shards(table_name, keys, fk_tables, schemas, on_conflict=None, conflict_keys=None, batch_size=10000, db=None):
+    # One INSERT ... SELECT for every attached shard, in rowid order, after
+    # merge_references. If a record breaks it, or the journal is off, the rows
+    # are read back batch_size at a time and written by insert_many. Returns
+    # (rowid, error, source record) for every record the database refused
+    db = resolve(db)
+
+    cursor = db.cursor()
+
+    # Shard id -> main id of every reference table, one lookup per row instead of two
+    for schema in schemas:
+        for i, fk_table in fk_tables.items():
+            cursor.execute('CREATE TEMP TABLE IF NOT EXISTS {} (shard_id INTEGER PRIMARY KEY, main_id INTEGER)'.format(
+                id_map_name(schema, i)))
+            cursor.execute('DELETE FROM temp.{}'.format(id_map_name(schema, i)))
+            cursor.execute('INSERT INTO temp.{0} SELECT g.id, f.id FROM {1}.{2} AS g JOIN main.{2} AS f ON f.value = g.value'.format(
+                id_map_name(schema, i), schema, fk_table))
+
+    formatted_keys = ', '.join(["'{}'".format(key) for key in keys])
+
+    query = '{} INTO main.{} ({}) {}{}'.format(
+        CONFLICT_VERBS.get(on_conflict, 'INSERT'), table_name, formatted_keys,
+        shard_select(table_name, keys, fk_tables, schemas),
+        upsert_clause(keys, conflict_keys) if on_conflict == 'update' else '')
+
+    rejected = []
+    merged = False
+
+    if can_roll_back(db):
+        try:
+            cursor.execute(query)
+            db.rows_written += max(cursor.rowcount, 0)
+            merged = True
+        except ROW_ERRORS:
+            pass
+
+    if not merged:
+        # Every shard is read in rowid order, a sort over all of them would hold the
+        # whole merge. Rows carry their shard, to read back the source of refused ones
+        shard_cursors = []
+
+        for schema in schemas:
+            shard_cursors.append(db.cursor())
+            shard_cursors[-1].execute(shard_select(table_name, keys, fk_tables, [schema], with_order=True))
+
+        rows = heapq.merge(*[shard_rows(n, shard_cursor) for n, shard_cursor in enumerate(shard_cursors)])
+
+        while True:
+            records = list(itertools.islice(rows, batch_size))
+
+            if not records:
+                break
+
+            positions = insert_many(table_name, keys, [record[2:] for record in records], on_conflict, conflict_keys, db)
+
+            for position, error in positions:
+                rowid, n = records[position][:2]
+                source = cursor.execute(shard_select(table_name, keys, fk_tables, [schemas[n]], True,
+                                                     where='csv2sqlite_order = ?'), (rowid,)).fetchone()
+                rejected.append((rowid, error, source))
+
+        for shard_cursor in shard_cursors:
+            shard_cursor.close()
+
+    for schema in schemas:
+        for i in fk_tables:
+            cursor.execute('DROP TABLE temp.{}'.format(id_map_name(schema, i)))
+
+    db.commit()
+    cursor.close()
+
+    return rejected
+
+
+LOOKUP_TABLE = 'csv2sqlite_lookup'
+
+
+def lookup_ids(table_name, values, db=None):
+    # value -> id of the given values found in a reference table. Joining a
+    # temporary table returns every value exactly as it was asked for, even
+    # when the reference table converted it to a number
+    db = resolve(db)
+
+    cursor = db.cursor()
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} (value)'.format(
+        index_name(table_name, ['value'], True), table_name))
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS {} (value)'.format(LOOKUP_TABLE))
+    cursor.execute('DELETE FROM {}'.format(LOOKUP_TABLE))
+    cursor.executemany('INSERT INTO {} VALUES (?)'.format(LOOKUP_TABLE), [(value,) for value in values])
+    cursor.execute('SELECT l.value, r.id FROM {} AS l JOIN {} AS r ON r.value = l.value'.format(
+        LOOKUP_TABLE, table_name))
+
+    results = dict(cursor.fetchall())
+    cursor.close()
+
+    return results
+
+
+def add_reference_values(table_name, values, db=None):
+    # Inserts the values a reference table doesn't have yet and returns their
+    # ids. The unique index compares values converted to the column type, so
+    # '007' and '7' share the row of the INTEGER 7
+    db = resolve(db)
+
+    cursor = db.cursor()
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} (value)'.format(
+        index_name(table_name, ['value'], True), table_name))
+    cursor.executemany('INSERT OR IGNORE INTO {} (value) VALUES (?)'.format(table_name),
+                       [(value,) for value in values if value is not None])
+    cursor.close()
+
+    return lookup_ids(table_name, values, db)
+
+
+def count(table_name, db=None):
+    db = resolve(db)
+
+    cursor = db.cursor()
 
     cursor.execute('SELECT COUNT(*) FROM {}'.format(table_name))
     results = cursor.fetchone()
@@ -170,8 +842,22 @@ def count(table_name):
 
     return results[0]
 
-def select_all(table_name, columns=None):
-    cursor = connection.cursor()
+def select_id_map(table_name, db=None):
+    db = resolve(db)
+
+    cursor = db.cursor()
+    cursor.execute('SELECT value, id FROM {}'.format(table_name))
+
+    results = cursor.fetchall()
+    cursor.close()
+
+    return results
+
+
+def select_all(table_name, columns=None, db=None):
+    db = resolve(db)
+
+    cursor = db.cursor()
 
     if columns:
         joined_columns = ', '.join(columns)
@@ -2,3 +2,9 @@ class CsvColumnNotFound(Exception):
     def __init__(self, line_number, column_index):
         self.line_number = line_number
         self.column_index = column_index
+
+
+class TooManyErrors(Exception):
+    def __init__(self, error_count, reject_path):
+        self.error_count = error_count
+        self.reject_path = reject_path
@@ -0,0 +1,91 @@
+import mmap
+import locale
+
+
+# Rows are decoded and split this many bytes at a time. Larger blocks create
+# more lists at once and spend the gain in garbage collection passes
+BLOCK_SIZE = 64 * 1024
+
+
+def is_simple(data):
+    # Without quotes every comma separates values and every newline ends a row.
+    # Lone carriage returns end rows for csv.reader, so they are left to it
+    if data.find(b'"') != -1:
+        return False
+
+    if data.find(b'\r') == -1:
+        return True
+
+    # mmap objects have no count(), they are compared a block at a time
+    start = 0
+
+    while start < len(data):
+        block = data[start:start + BLOCK_SIZE]
+
+        # A carriage return ending the block is checked with the next byte
+        if block.endswith(b'\r'):
+            block += data[start + BLOCK_SIZE:start + BLOCK_SIZE + 1]
+
+        if block.count(b'\r') != block.count(b'\r\n'):
+            return False
+
+        start += len(block)
+
+    return True
+
+
+def is_simple_file(csv_path):
+    with open(csv_path, mode='rb') as csv_file:
+        try:
+            data = mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return False
+
+        with data:
+            return is_simple(data)
+
+
+def split_rows(text):
+    # Same rows as csv.reader gives for quote-free text, blank lines included
+    lines = text.replace('\r\n', '\n').split('\n')
+
+    if lines[-1] == '':
+        lines.pop()
+
+    return [line.split(',') if line else [] for line in lines]
+
+
+def block_end(data, start, size):
+    if start + BLOCK_SIZE >= size:
+        return size
+
+    # Blocks end after a newline, or after the row that is longer than a block
+    end = data.rfind(b'\n', start, start + BLOCK_SIZE)
+
+    if end == -1:
+        end = data.find(b'\n', start + BLOCK_SIZE)
+
+    return size if end == -1 else end + 1
+
+
+def iter_rows(csv_path, start=0, encoding=None, position=None):
+    # Every block is decoded with a single call, newline bytes never split a
+    # character in the encodings text mode would use. `position` follows the
+    # end of the last block, see progress.py
+    encoding = encoding or locale.getpreferredencoding(False)
+
+    if position is not None:
+        position.update(path=csv_path, tell=lambda: start)
+
+    with open(csv_path, mode='rb') as csv_file:
+        with mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size = len(data)
+
+            while start < size:
+                end = block_end(data, start, size)
+
+                for row in split_rows(data[start:end].decode(encoding)):
+                    yield row
+
+                start = end
@@ -0,0 +1,83 @@
+import sys
+import collections
+
+import dbutils
+
+
+# Estimated bytes taken by a cache entry besides its value: dictionary slot,
+# linked list node and the id
+ENTRY_OVERHEAD = 128
+
+
+class FkCache:
+    # value -> id pairs of one reference table. The least recently used pairs
+    # are evicted once their estimated size goes over max_bytes
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, value):
+        row_id = self.entries.get(value)
+
+        if row_id is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(value)
+
+        return row_id
+
+    def put(self, value, row_id):
+        if value not in self.entries:
+            self.size += sys.getsizeof(value) + ENTRY_OVERHEAD
+
+        self.entries[value] = row_id
+        self.entries.move_to_end(value)
+
+        while self.size > self.max_bytes and self.entries:
+            evicted, _ = self.entries.popitem(last=False)
+            self.size -= sys.getsizeof(evicted) + ENTRY_OVERHEAD
+            self.evictions += 1
+
+
+def resolve_ids(cache, table_name, values, db=None):
+    # Ids of every value of a batch. Cache misses are looked up together, and
+    # the ones the reference table doesn't have yet are inserted. Both go
+    # through SQLite, which sees '007' and '7' as one value of an INTEGER table
+    fk_ids = {}
+    missing = []
+
+    for value in values:
+        if value is None:
+            # NULL values have no id, like in the sql engine
+            fk_ids[value] = None
+            continue
+
+        row_id = cache.get(value)
+
+        if row_id is None:
+            missing.append(value)
+        else:
+            fk_ids[value] = row_id
+
+    if missing:
+        found = dbutils.lookup_ids(table_name, missing, db)
+        new_values = [value for value in missing if value not in found]
+
+        if new_values:
+            found.update(dbutils.add_reference_values(table_name, new_values, db))
+
+        for value in missing:
+            # Values the reference table refused stay without an id
+            fk_ids[value] = found.get(value)
+
+            if fk_ids[value] is not None:
+                cache.put(value, fk_ids[value])
+
+    return fk_ids
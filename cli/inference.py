@@ -0,0 +1,170 @@
+import os
+import re
+import json
+import hashlib
+import datetime
+
+import exceptions
+
+
+# Compared in lower case, \N is what MySQL and PostgreSQL dumps use
+NULL_VALUES = {'', 'null', '\\n'}
+BOOLEAN_VALUES = {'true', 'false', 'yes', 'no'}
+
+ISO_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+ISO_DATETIME = re.compile(r'^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?$')
+
+NoneType = type(None)
+
+ALL_TYPES = [NoneType, int, float, bool, datetime.date, datetime.datetime, str]
+
+CACHE_FILE_NAME = '.csv2sqlite-schema.json'
+
+
+def get_data_type(value):
+    value = value.strip()
+
+    if value.lower() in NULL_VALUES:
+        return NoneType
+
+    if value[0] == '+' or value[0] == '-':
+        unsigned = value[1:]
+    else:
+        unsigned = value
+
+    if unsigned.isdigit():
+        return int
+
+    if unsigned.count('.') == 1 and unsigned.replace('.', '', 1).isdigit():
+        return float
+
+    if value.lower() in BOOLEAN_VALUES:
+        return bool
+
+    if ISO_DATE.match(value):
+        return datetime.date
+
+    if ISO_DATETIME.match(value):
+        return datetime.datetime
+
+    return str
+
+
+def resolve_type(count):
+    found = [the_type for the_type in count if the_type is not NoneType and count[the_type] > 0]
+
+    if not found:
+        # Nothing but empty values
+        return str
+
+    if len(found) == 1:
+        return found[0]
+
+    if set(found) <= {int, float}:
+        return float
+
+    if set(found) <= {datetime.date, datetime.datetime}:
+        return datetime.datetime
+
+    return str
+
+
+class SchemaInference:
+    # Keeps a count of value types for every column, one row at a time
+
+    def __init__(self, column_count=None):
+        self.column_count = column_count
+        self.counts = None
+        self.rows = 0
+
+        if column_count is not None:
+            self._reset(column_count)
+
+    def _reset(self, column_count):
+        self.column_count = column_count
+        self.counts = [dict((the_type, 0) for the_type in ALL_TYPES)
+                       for i in range(0, column_count)]
+
+    def update(self, row, line_number=None):
+        if self.counts is None:
+            self._reset(len(row))
+
+        self.rows += 1
+
+        if len(row) < self.column_count:
+            raise exceptions.CsvColumnNotFound(line_number or self.rows, len(row))
+
+        for count, value in zip(self.counts, row):
+            count[get_data_type(value)] += 1
+
+    def update_many(self, rows, stride=1):
+        for i, row in enumerate(rows):
+            if i % stride == 0:
+                self.update(row, i + 1)
+
+    def types(self):
+        return [resolve_type(count) for count in self.counts or []]
+
+
+def guess_column_type(generator):
+    count = dict((the_type, 0) for the_type in ALL_TYPES)
+
+    for val in generator:
+        count[get_data_type(val)] += 1
+
+    return resolve_type(count)
+
+
+def estimate_stride(sample, file_size, sample_size):
+    # Spread sample_size rows over the whole file, based on the average row size
+    sample_bytes = sum(len(value) + 1 for row in sample for value in row)
+
+    if not sample_bytes:
+        return 1
+
+    estimated_rows = file_size * len(sample) // sample_bytes
+
+    return max(1, estimated_rows // sample_size)
+
+
+def header_hash(headers):
+    return hashlib.sha1('\x1f'.join(headers).encode('utf-8')).hexdigest()
+
+
+def cache_path(csv_path):
+    return os.path.join(os.path.dirname(os.path.abspath(csv_path)), CACHE_FILE_NAME)
+
+
+def load_cached_types(csv_path, headers):
+    path = cache_path(csv_path)
+
+    if not headers or not os.path.exists(path):
+        return None
+
+    with open(path) as cache_file:
+        try:
+            cache = json.load(cache_file)
+        except ValueError:
+            return None
+
+    return cache.get(header_hash(headers))
+
+
+def save_cached_types(csv_path, headers, sqlite_types):
+    if not headers:
+        return
+
+    path = cache_path(csv_path)
+    cache = {}
+
+    if os.path.exists(path):
+        with open(path) as cache_file:
+            try:
+                cache = json.load(cache_file)
+            except ValueError:
+                cache = {}
+
+    cache[header_hash(headers)] = sqlite_types
+
+    with open(path, 'w') as cache_file:
+        json.dump(cache, cache_file, indent=4)
@@ -1,19 +1,114 @@
+import io
 import os
 import re
 import bz2
 import csv
 import sys
 import gzip
+import glob
 import json
+import lzma
+import bisect
+import locale
 import ntpath
 import zipfile
+import shutil
+import hashlib
+import tempfile
+import itertools
 import collections
 import importlib.util
 from operator import itemgetter
 
 import transformations
 import exceptions
+import inference
+import mappingcache
+import fastcsv
+import fkcache
+import parallel
+import progress
 import dbutils
+import stats
+
+
+# Number of leading rows used to guess column types
+TYPE_SAMPLE_SIZE = 1000
+
+DEFAULT_OPTIONS = {
+    'batch_size': 10000,
+    'workers': 1,
+    'profile': 'safe',
+    'defer_indexes': False,
+    'fk_indexes': True,
+    'type_sample': 'head',
+    'type_sample_size': TYPE_SAMPLE_SIZE,
+    'schema_cache': False,
+    'mapping_cache': False,
+    'stats': False,
+    'stats_json': None,
+    'incremental': False,
+    'on_conflict': None,
+    'max_errors': None,
+    'reject_file': None,
+    'build_in_memory': 'never',
+    'fk_engine': 'python',
+    'fk_max_memory': None,
+    'queue_size': 0,
+    'shards': 0,
+    'progress': False,
+}
+
+CONFLICT_MODES = ['ignore', 'replace', 'update']
+
+# Automatic in-memory builds may use this share of the available memory
+MEMORY_BUILD_FRACTION = 0.5
+
+# Rough database size relative to its CSV input, and uncompressed size of compressed input
+DATABASE_SIZE_FACTOR = 2
+COMPRESSION_RATIO = 5
+
+# Bytes from the start of a file identifying it in incremental imports
+FINGERPRINT_SIZE = 4096
+
+# Kept here for library callers
+get_data_type = inference.get_data_type
+guess_column_type = inference.guess_column_type
+
+# Set in every worker process by init_worker
+worker_transform = None
+
+# Database, table and mappings of a worker writing a shard, set by init_shard_worker
+worker_shard = None
+
+# Rows of the n-th range of a sharded import get rowids from n * SHARD_ROWS + 1
+SHARD_ROWS = 2 ** 32
+
+# Mapping settings workers rebuild transformations and shard tables from
+WORKER_SETTINGS = ['csv_index', 'column_name', 'data_type', 'key', 'transform_name']
+
+
+# Compressed inputs are recognized by extension first, then by magic bytes
+COMPRESSION_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.gzip': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+    '.lzma': 'xz',
+    '.zip': 'zip',
+}
+
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'PK\x03\x04', 'zip'),
+]
+
+
+def get_option(args, name):
+    # Library callers may pass partial argument objects
+    return getattr(args, name, DEFAULT_OPTIONS[name])
 
 
 def load_and_process_mapping_config(mapping_path, default_table_name, default_mapping_action):
@@ -40,43 +135,179 @@ def load_and_process_mapping_config(mapping_path, default_table_name, default_ma
     return (table_name, custom_transformations, mappings, default_mapping_action)
 
 
-def import_csv(all_csv_data, table_name, mappings):
-    keys = []
+def load_index_config(mapping_path):
+    if not mapping_path:
+        return []
+
+    with open(mapping_path) as data_file:
+        json_data = json.load(data_file)
+
+    indexes = []
+
+    # Either a list of column names or {"columns": [...], "unique": true}
+    for index in json_data.get('indexes', []):
+        if isinstance(index, dict):
+            indexes.append({'columns': index['columns'], 'unique': index.get('unique', False)})
+        else:
+            indexes.append({'columns': index, 'unique': False})
+
+    return indexes
+
+
+def table_column_name(mapping):
+    if 'key' in mapping and mapping['key'] == 'fk':
+        return mapping['column_name'] + '_id'
+
+    return mapping['column_name']
+
+
+def table_indexes(mappings, index_config, defer_pk, fk_indexes):
+    indexes = []
+    pk_columns = []
+
+    # FK columns may be referred to by their reference table name
+    column_names = dict((mapping['column_name'], table_column_name(mapping)) for mapping in mappings)
 
     for mapping in mappings:
+        column_name = table_column_name(mapping)
+
+        if 'key' in mapping and mapping['key'] == 'pk':
+            pk_columns.append(column_name)
+        elif 'key' in mapping and mapping['key'] == 'fk' and fk_indexes:
+            indexes.append({'columns': [column_name], 'unique': False})
+        elif mapping.get('index'):
+            indexes.append({'columns': [column_name], 'unique': False})
+
+    for index in index_config:
+        columns = [column_names.get(column, column) for column in index['columns']]
+        indexes.append({'columns': columns, 'unique': index['unique']})
+
+    if defer_pk and pk_columns:
+        indexes.insert(0, {'columns': pk_columns, 'unique': True})
+
+    return indexes
+
+
+def conflict_mode(args, mappings):
+    # The command line wins over the "insert_mode" of the mapped primary key
+    on_conflict = get_option(args, 'on_conflict')
+
+    for mapping in mappings:
+        if not on_conflict and mapping.get('key') == 'pk' and mapping.get('insert_mode') in CONFLICT_MODES:
+            on_conflict = mapping['insert_mode']
+
+    return on_conflict
+
+
+def table_keys(mappings):
+    keys = []
+    pk_positions = []
+
+    for i, mapping in enumerate(mappings):
         column_name = mapping['column_name']
 
         if 'key' in mapping and mapping['key'] == 'fk':
             column_name = column_name + '_id'
+        elif 'key' in mapping and mapping['key'] == 'pk':
+            pk_positions.append(i)
 
         keys.append(column_name)
 
-    dbutils.insert_many(table_name, keys, all_csv_data)
+    return keys, pk_positions
+
+
+def count_new_keys(all_csv_data, table_name, pk_columns, pk_positions, db=None):
+    # Every key seen again, in this batch or in the table, is an update or a skip
+    chunk_keys = set(tuple(row[i] for i in pk_positions) for row in all_csv_data)
+
+    return len(chunk_keys) - dbutils.count_existing(table_name, pk_columns, chunk_keys, db)
+
+
+def conflict_results(on_conflict, row_count, inserted, rejected, count_conflicts=True):
+    # Without counts, a key built after loading counts its duplicates once
+    if not on_conflict or not count_conflicts:
+        return None, rejected
+
+    inserted = max(inserted - len(rejected), 0)
+    duplicates = row_count - len(rejected) - inserted
+
+    if on_conflict == 'ignore':
+        return (inserted, 0, duplicates), rejected
+
+    return (inserted, duplicates, 0), rejected
+
+
+def import_csv(all_csv_data, table_name, mappings, on_conflict=None, count_conflicts=True, db=None):
+    keys, pk_positions = table_keys(mappings)
+    pk_columns = [keys[i] for i in pk_positions]
+    inserted = len(all_csv_data)
+
+    if on_conflict and pk_columns and count_conflicts:
+        inserted = count_new_keys(all_csv_data, table_name, pk_columns, pk_positions, db)
+
+    rejected = dbutils.insert_many(table_name, keys, all_csv_data, on_conflict, pk_columns, db)
+
+    return conflict_results(on_conflict, len(all_csv_data), inserted, rejected, count_conflicts)
+
+
+def fk_tables(mappings):
+    # Row position -> reference table
+    return dict((i, mapping['column_name']) for i, mapping in enumerate(mappings) if mapping.get('key') == 'fk')
+
+
+def import_staged(all_csv_data, table_name, mappings, on_conflict=None, count_conflicts=True, db=None):
+    # Same as import_csv, for rows already loaded by dbutils.load_staging
+    keys, pk_positions = table_keys(mappings)
+    pk_columns = [keys[i] for i in pk_positions]
+    inserted = len(all_csv_data)
+
+    if on_conflict and pk_columns and count_conflicts:
+        inserted = count_new_keys(all_csv_data, table_name, pk_columns, pk_positions, db)
+
+    rejected = dbutils.insert_from_staging(table_name, keys, staging_name(table_name), fk_tables(mappings),
+                                           on_conflict, pk_columns, db)
+
+    return conflict_results(on_conflict, len(all_csv_data), inserted, rejected, count_conflicts)
+
+
+def staging_name(table_name):
+    return 'csv2sqlite_staging_' + table_name
 
 
 def read_key_mappings(all_data, mappings):
     fk_mappings = []
     pk_mapping = None
 
-    for mapping in mappings:
+    for i, mapping in enumerate(mappings):
         if 'key' in mapping and mapping['key'] == 'fk':
+            # Position of the value inside a transformed row
+            mapping['row_index'] = i
             fk_mappings.append(mapping)
 
         elif 'key' in mapping and mapping['key'] == 'pk':
             pk_mapping = mapping
 
     for mapping in fk_mappings:
-        mapping['dataset'] = set()
-
-    for row in all_data:
-        for mapping in fk_mappings:
-            index = mapping['csv_index']
-            mapping['dataset'].add(row[index])
+        index = mapping['row_index']
+        mapping['dataset'] = set(row[index] for row in all_data)
 
     return fk_mappings, pk_mapping
 
 
-def fk_mappings_to_database(fk_mappings):
+def load_fk_ids(table_name, db=None):
+    fk_ids = {}
+
+    for value, row_id in dbutils.select_id_map(table_name, db):
+        fk_ids[value] = row_id
+
+        # Numeric affinity turns CSV text into numbers, keep the text form too
+        if not isinstance(value, str):
+            fk_ids.setdefault(str(value), row_id)
+
+    return fk_ids
+
+
+def fk_mappings_to_database(fk_mappings, db=None):
     if not fk_mappings:
         return
 
@@ -84,23 +315,35 @@ def fk_mappings_to_database(fk_mappings):
 
     for mapping in fk_mappings:
         # FK tables have the same name as FK column
-        table_name = column_name = mapping['column_name']
+        table_name = mapping['column_name']
 
-        db_results = dbutils.select_all(column_name, ['id', 'value'])
+        # A memory bounded cache only keeps the most used ids
+        if 'fk_cache' in mapping:
+            fk_patch_data.append({
+                'row_index': mapping['row_index'],
+                'fk_ids': fkcache.resolve_ids(mapping['fk_cache'], table_name, mapping['dataset'], db),
+            })
+            continue
 
-        db_set = set()
-        for result in db_results:
-            db_set.add(result['value'])
+        # value -> id map, read from the database once and reused by every batch
+        if 'fk_ids' not in mapping:
+            mapping['fk_ids'] = load_fk_ids(table_name, db=db)
 
-        diff_set = mapping['dataset'] - db_set
+        fk_ids = mapping['fk_ids']
+        diff_set = mapping['dataset'] - fk_ids.keys()
 
-        # Insert only new values in the database
-        for value in diff_set:
-            dbutils.insert(table_name, {'value': value})
+        # Insert only new values in the database, SQLite matches values the
+        # reference table converted to numbers with the text read from the CSV
+        if diff_set:
+            found = dbutils.add_reference_values(table_name, diff_set, db)
+
+            # NULL and values the reference table refused stay without an id
+            for value in diff_set:
+                fk_ids[value] = found.get(value)
 
         fk_patch_data.append({
-            'csv_index': mapping['csv_index'],
-            'db_values': dbutils.select_all(table_name, ['id', 'value']),
+            'row_index': mapping['row_index'],
+            'fk_ids': fk_ids,
         })
 
     return fk_patch_data
@@ -111,22 +354,19 @@ def pk_table_to_database(pk_table):
         return
 
 
-def get_column_id(index, column, values):
-    for value in values:
-        if column == value['value']:
-            return value['id']
-
-
 def patch_csv_data(fk_patch_data, all_csv_data):
     if not fk_patch_data:
-        return
+        return all_csv_data
+
+    columns = list(zip(*all_csv_data))
+
+    for fk_patch_item in fk_patch_data:
+        index = fk_patch_item['row_index']
 
-    for row in all_csv_data:
-        for fk_patch_item in fk_patch_data:
-            index = fk_patch_item['csv_index']
+        # Replace column values with respective ids from new table
+        columns[index] = map(fk_patch_item['fk_ids'].__getitem__, columns[index])
 
-            # Replace row value with respective id from new table
-            row[index] = get_column_id(index, row[index], fk_patch_item['db_values'])
+    return list(zip(*columns))
 
 
 def fill_missing_mappings(column_length, mappings):
@@ -146,26 +386,46 @@ def clean_name(name):
     return re.sub('[^0-9a-zA-Z]+', '_', name)
 
 
-def set_mapping_defaults(all_csv_data, mappings, headers, default_mapping_action):
-    def column_gen(column_index, row_count):
-        for i in range(0, min(row_count, 1000)):
-            try:
-                yield all_csv_data[i][column_index]
-            except IndexError:
-                raise exceptions.CsvColumnNotFound(i + 1, column_index)
+def infer_column_types(all_csv_data, headers):
+    engine = inference.SchemaInference(None if all_csv_data else len(headers))
+    engine.update_many(all_csv_data)
+
+    return [dbutils.python_to_sqlite_type(python_type) for python_type in engine.types()]
+
+
+def sample_column_types(csv_path, csv_has_title_columns, headers, sample, type_sample, sample_size):
+    if type_sample == 'head':
+        return infer_column_types(sample, headers)
+
+    if type_sample == 'stride':
+        stride = inference.estimate_stride(sample, os.path.getsize(csv_path), sample_size)
+    else:
+        stride = 1
+
+    # One extra pass over the file, every column is updated from the same row
+    rows = csv_iter_file(csv_path, csv_has_title_columns)
 
-    types = []
-    column_length = len(all_csv_data[0])
-    row_length = len(all_csv_data)
+    if csv_has_title_columns:
+        next(rows, None)
+
+    engine = inference.SchemaInference(None if sample else len(headers))
+    engine.update_many(rows, stride)
+
+    return [dbutils.python_to_sqlite_type(python_type) for python_type in engine.types()]
+
+
+def set_mapping_defaults(all_csv_data, mappings, headers, default_mapping_action, types=None, registry=None):
+    if types is None:
+        types = infer_column_types(all_csv_data, headers)
+
+    if registry is None:
+        registry = transformation_registry()
+
+    column_length = len(types)
 
     if default_mapping_action == 'import':
         mappings = fill_missing_mappings(column_length, mappings)
 
-    for i in range(0, column_length):
-        python_type = guess_column_type(column_gen(i, row_length))
-        sqlite_type = dbutils.python_to_sqlite_type(python_type)
-        types.append(sqlite_type)
-
     # Patch named indices (convert names to position)
     for mapping in mappings:
         mapping_index = mapping['csv_index']
@@ -190,10 +450,17 @@ def set_mapping_defaults(all_csv_data, mappings, headers, default_mapping_action
         if 'transform' not in mapping:
             mapping['transform'] = None
         else:
-            mapping['transform'] = getattr(transformations, mapping['transform'])
+            # Worker processes resolve transformations again by name
+            mapping['transform_name'] = mapping['transform']
+            mapping['transform'] = registry[mapping['transform']]
+
 
+def transformation_registry():
+    # Transformation name -> function, custom ones are added per import
+    return dict((name, getattr(transformations, name)) for name in dir(transformations) if name[0:2] != '__')
 
-def load_custom_transformations(mapping_path, custom_transformations_path):
+
+def load_custom_transformations(mapping_path, custom_transformations_path, registry):
     # use json path as reference
     path = os.path.abspath(os.path.dirname(mapping_path))
 
@@ -209,43 +476,7 @@ def load_custom_transformations(mapping_path, custom_transformations_path):
     for function_name in dir(module):
         # Remove internal stuff
         if function_name[0:2] != '__':
-            func = getattr(module, function_name)
-            setattr(transformations, function_name, func)
-
-
-def get_data_type(value):
-    value = value.strip()
-
-    if value[0] == '+' or value[0] == '-':
-        value = value[1:]
-
-    if value.isdigit():
-        return int
-
-    if value.count(".") == 1 and value.replace(".", "", 1).isdigit():
-        return float
-
-    return str
-
-
-def guess_column_type(generator):
-    count = {
-        int: 0,
-        float: 0,
-        str: 0
-    }
-
-    for val in generator:
-        the_type = get_data_type(val)
-        count[the_type] += 1
-
-    if count[str] > 0:
-        return str
-
-    if count[float] > 0:
-        return float
-
-    return int
+            registry[function_name] = getattr(module, function_name)
 
 
 # TODO - Refactor
@@ -271,50 +502,702 @@ def uniquefy_names(mappings):
             mapping['column_name'] = key
 
 
-# TODO - Looks ineficient
+def compile_transform(mappings):
+    # Generates a function turning a chunk of CSV rows into a list of tuples
+    # ready for executemany, e.g. for two mappings where the second one has
+    # a transformation:
+    #
+    #   def chunk_transform(chunk):
+    #       return [(row[0], t1(row[3])) for row in chunk]
+    #
+    # Transformations with a `batch` attribute receive the whole column at once
+    namespace = {}
+    batch_lines = []
+    batch_names = []
+    values = []
+
+    for n, mapping in enumerate(mappings):
+        index = mapping['csv_index']
+        transform = mapping['transform']
+
+        if not transform:
+            values.append('row[{}]'.format(index))
+        elif hasattr(transform, 'batch'):
+            namespace['b{}'.format(n)] = transform.batch
+            batch_lines.append('    c{0} = b{0}([row[{1}] for row in chunk])'.format(n, index))
+            batch_names.append('v{}'.format(n))
+            values.append('v{}'.format(n))
+        else:
+            namespace['t{}'.format(n)] = transform
+            values.append('t{}(row[{}])'.format(n, index))
+
+    row_expression = '({},)'.format(', '.join(values)) if values else '()'
+
+    lines = ['def chunk_transform(chunk):']
+
+    if batch_lines:
+        batch_columns = ', '.join('c' + name[1:] for name in batch_names)
+
+        lines.append('    chunk = chunk if isinstance(chunk, list) else list(chunk)')
+        lines.extend(batch_lines)
+        lines.append('    return [{} for row, {} in zip(chunk, {})]'.format(
+            row_expression, ', '.join(batch_names), batch_columns))
+    else:
+        lines.append('    return [{} for row in chunk]'.format(row_expression))
+
+    exec('\n'.join(lines), namespace)
+
+    return namespace['chunk_transform']
+
+
 def csv_transform(all_csv_data, mappings):
-    new_csv_data = []
+    return compile_transform(mappings)(all_csv_data)
 
-    for row in all_csv_data:
-        new_row = []
 
-        for mapping in mappings:
-            val = row[mapping['csv_index']]
+def detect_compression(csv_path):
+    extension = os.path.splitext(csv_path)[1].lower()
 
-            if mapping['transform']:
-                new_row.append(mapping['transform'](val))
-            else:
-                new_row.append(val)
+    if extension in COMPRESSION_EXTENSIONS:
+        return COMPRESSION_EXTENSIONS[extension]
+
+    with open(csv_path, mode='rb') as raw_file:
+        head = raw_file.read(8)
+
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+
+    return None
+
+
+def csv_open_streams(csv_path, position=None):
+    compression = detect_compression(csv_path)
+
+    # Decompressors read from this file, its position is the compressed one
+    with open(csv_path, mode='rb') as raw_file:
+        if position is not None:
+            position.update(path=csv_path, tell=raw_file.tell)
+
+        if compression is None:
+            yield io.TextIOWrapper(raw_file, newline='')
+        elif compression == 'gzip':
+            yield gzip.open(raw_file, mode='rt', newline='')
+        elif compression == 'bz2':
+            yield bz2.open(raw_file, mode='rt', newline='')
+        elif compression == 'xz':
+            yield lzma.open(raw_file, mode='rt', newline='')
+        elif compression == 'zip':
+            with zipfile.ZipFile(raw_file) as archive:
+                names = [name for name in archive.namelist() if not name.endswith('/')]
+                csv_names = [name for name in names if name.lower().endswith('.csv')]
+
+                # Every CSV member is imported in archive order
+                for name in csv_names or names:
+                    yield io.TextIOWrapper(archive.open(name), newline='')
+
+
+def csv_iter_file(csv_path, has_headers=False, position=None, records=None):
+    # `records` gets the file as it starts and its row count once it is read
+    headers = 1 if has_headers else 0
+    count = 0
+
+    if records is not None:
+        records.add(csv_path, headers)
+
+    # Quote-free files skip the csv module
+    if detect_compression(csv_path) is None and fastcsv.is_simple_file(csv_path):
+        for count, row in enumerate(fastcsv.iter_rows(csv_path, position=position), 1):
+            yield row
+    else:
+        for i, stream in enumerate(csv_open_streams(csv_path, position)):
+            with stream:
+                reader = csv.reader(stream)
+
+                # Only the first member's headers reach the caller
+                if has_headers and i > 0:
+                    next(reader, None)
+
+                for count, row in enumerate(reader, count + 1):
+                    yield row
+
+    if records is not None:
+        records.count(max(count - headers, 0))
+
+
+def record_lines(csv_path, has_headers=False):
+    # Line on which every record csv_iter_file yields starts. Lines of zip
+    # members are counted one after the other
+    if detect_compression(csv_path) is None and fastcsv.is_simple_file(csv_path):
+        yield from itertools.count(1)
+        return
+
+    lines = 0
+
+    for i, stream in enumerate(csv_open_streams(csv_path)):
+        with stream:
+            reader = csv.reader(stream)
+
+            if has_headers and i > 0:
+                next(reader, None)
+
+            start = reader.line_num
+
+            for row in reader:
+                yield lines + start + 1
+                start = reader.line_num
+
+            lines += reader.line_num
+
+
+class InputRecords:
+    # File and line of the records of an import, found by their position in
+    # it. Readers add every file, or part of a file, as they start it. Lines
+    # are only worked out for the records looked up, by reading the file again
+    # unless every line holds a record
+
+    def __init__(self, has_headers=False):
+        self.has_headers = has_headers
+        self.firsts = []
+        self.parts = []
+        self.total = 0
+        self.lines = None
+
+    def add(self, csv_path, index, rows=0):
+        # A part of csv_path starting with its index-th record, headers
+        # included. Returns the position of that record in the import
+        self.firsts.append(self.total)
+        self.parts.append((csv_path, index))
+        self.total += rows
+
+        return self.firsts[-1]
+
+    def count(self, rows):
+        self.total += rows
+
+    def locate(self, position):
+        part = bisect.bisect_right(self.firsts, position) - 1
+        csv_path, index = self.parts[part]
+
+        return csv_path, self.line(csv_path, index + position - self.firsts[part])
+
+    def line(self, csv_path, index):
+        # Lookups usually move forward, the file is only read again from the start when they don't
+        if self.lines is None or self.lines[0] != csv_path or self.lines[1] > index:
+            self.lines = [csv_path, 0, record_lines(csv_path, self.has_headers)]
 
-        new_csv_data.append(new_row)
+        line = next(itertools.islice(self.lines[2], index - self.lines[1], None))
+        self.lines[1] = index + 1
 
-    return new_csv_data
+        return line
+
+
+def csv_data_rows(csv_path, csv_has_title_columns, position=None, records=None):
+    rows = csv_iter_file(csv_path, csv_has_title_columns, position, records)
+
+    if csv_has_title_columns:
+        next(rows, None)
+
+    return rows
+
+
+def expand_inputs(inputs):
+    # Accepts paths, glob patterns and directories, in the given order
+    if isinstance(inputs, str):
+        inputs = [inputs]
+
+    csv_paths = []
+
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            names = sorted(os.listdir(input_path))
+            csv_paths.extend(os.path.join(input_path, name) for name in names
+                             if not name.startswith('.') and os.path.isfile(os.path.join(input_path, name)))
+        elif glob.has_magic(input_path):
+            csv_paths.extend(sorted(glob.glob(input_path)))
+        else:
+            csv_paths.append(input_path)
+
+    return csv_paths
+
+
+def csv_iter_offsets(csv_path, start=0):
+    # Yields (row, byte offset after the row). csv.reader pulls exactly the
+    # lines of the current row, so the offset always falls on a row boundary
+    encoding = locale.getpreferredencoding(False)
+    position = [start]
+
+    def lines(csv_file):
+        for line in csv_file:
+            # A last line without newline may still be being written
+            if not line.endswith(b'\n'):
+                return
+
+            position[0] += len(line)
+            yield line.decode(encoding)
+
+    with open(csv_path, mode='rb') as csv_file:
+        csv_file.seek(start)
+
+        for row in csv.reader(lines(csv_file)):
+            yield row, position[0]
+
+
+def file_fingerprint(csv_path, size):
+    with open(csv_path, mode='rb') as csv_file:
+        return hashlib.sha1(csv_file.read(size)).hexdigest()
+
+
+def incremental_chunks(csv_paths, table_name, csv_has_title_columns, batch_size, progress, db=None, position=None,
+                       records=None):
+    # Only reads what was appended since the last committed chunk of every
+    # file. `progress` describes the end of the chunk that was just yielded
+    for csv_path in csv_paths:
+        if detect_compression(csv_path) is not None:
+            raise Exception('Incremental imports need uncompressed files: "{}"'.format(csv_path))
+
+        source = os.path.abspath(csv_path)
+        checkpoint = dbutils.get_checkpoint(source, table_name, db)
+        start, row_count = 0, 0
+
+        if checkpoint and checkpoint['byte_offset'] <= os.path.getsize(csv_path):
+            size = min(FINGERPRINT_SIZE, checkpoint['byte_offset'])
+
+            # A different head means the file was replaced, start over
+            if file_fingerprint(csv_path, size) == checkpoint['fingerprint']:
+                start, row_count = checkpoint['byte_offset'], checkpoint['row_count']
+
+        if start == 0 and csv_has_title_columns:
+            start = parallel.first_row_end(csv_path)
+
+        rows = csv_iter_offsets(csv_path, start)
+
+        if records is not None:
+            records.add(csv_path, row_count + (1 if csv_has_title_columns else 0))
+
+        if position is not None:
+            position['skipped'] = position.get('skipped', 0) + start
+            position.update(path=csv_path, tell=lambda: progress['byte_offset'] if progress.get('source') == source else start)
+
+        for chunk in chunked(rows, batch_size):
+            offset = chunk[-1][1]
+            row_count += len(chunk)
+
+            if records is not None:
+                records.count(len(chunk))
+
+            progress.update({
+                'source': source,
+                'byte_offset': offset,
+                'row_count': row_count,
+                'fingerprint': file_fingerprint(csv_path, min(FINGERPRINT_SIZE, offset)),
+            })
+
+            yield [row for row, _ in chunk]
 
 
 def csv_read_file(csv_path):
-    all_csv_data = []
+    return list(csv_iter_file(csv_path))
+
+
+def default_table_name(csv_path):
+    name = ntpath.basename(csv_path)
+    name, extension = os.path.splitext(name)
+
+    if extension.lower() in COMPRESSION_EXTENSIONS:
+        name = os.path.splitext(name)[0]
+
+    return name
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def transform_chunks(chunks, mappings):
+    chunk_transform = compile_transform(mappings)
 
-    csv_file = open(csv_path, mode='r')
+    for chunk in chunks:
+        yield chunk_transform(chunk)
 
-    reader = csv.reader(csv_file)
 
-    for row in reader:
-        all_csv_data.append(row)
+def init_worker(mapping_path, custom_transformations, mappings):
+    global worker_transform
 
-    csv_file.close()
+    registry = transformation_registry()
 
-    return all_csv_data
+    if custom_transformations:
+        load_custom_transformations(mapping_path, custom_transformations, registry)
+
+    worker_mappings = []
+
+    for mapping in mappings:
+        transform = None
+
+        if mapping.get('transform_name'):
+            transform = registry[mapping['transform_name']]
+
+        worker_mapping = dict(mapping)
+        worker_mapping['transform'] = transform
+        worker_mappings.append(worker_mapping)
+
+    worker_transform = compile_transform(worker_mappings)
+
+
+def transform_range(csv_path, start, end):
+    with open(csv_path, mode='rb') as csv_file:
+        csv_file.seek(start)
+        data = csv_file.read(end - start)
+
+    if fastcsv.is_simple(data):
+        return worker_transform(fastcsv.split_rows(data.decode(locale.getpreferredencoding(False))))
+
+    stream = io.TextIOWrapper(io.BytesIO(data), newline='')
+
+    return worker_transform(csv.reader(stream))
+
+
+def transform_file(csv_path, csv_has_title_columns):
+    return worker_transform(csv_data_rows(csv_path, csv_has_title_columns))
+
+
+def file_tasks(csv_paths, csv_has_title_columns, position=None, task_files=None):
+    # `position` counts ranges and files as read once they are handed out,
+    # `task_files` gets the index of the file of every task
+    for i, csv_path in enumerate(csv_paths):
+        if detect_compression(csv_path) is None:
+            start = parallel.first_row_end(csv_path) if csv_has_title_columns else 0
+
+            for func, task in parallel.range_tasks(csv_path, start, transform_range):
+                if position is not None:
+                    position.update(path=csv_path, tell=lambda end=task[2]: end)
+
+                if task_files is not None:
+                    task_files.append(i)
+
+                yield func, task
+        else:
+            # Compressed files can't be split, a worker transforms the whole file
+            if position is not None:
+                position.update(path=csv_path, tell=lambda size=os.path.getsize(csv_path): size)
+
+            if task_files is not None:
+                task_files.append(i)
+
+            yield transform_file, (csv_path, csv_has_title_columns)
+
+
+def counted_tasks(results, csv_paths, task_files, records, rows=len):
+    # Adds the rows of every task to `records`, in task order. Yields the
+    # position of the first row of every task with its result
+    indexes = {}
+
+    for result in results:
+        i = task_files.popleft()
+        index = indexes.get(i, 1 if records.has_headers else 0)
+        indexes[i] = index + rows(result)
+
+        yield records.add(csv_paths[i], index, rows(result)), result
+
+
+def parallel_transform_chunks(csv_paths, csv_has_title_columns, mapping_path,
+                              custom_transformations, mappings, workers, records, position=None):
+    task_files = collections.deque()
+    results = parallel.map_tasks(file_tasks(csv_paths, csv_has_title_columns, position, task_files), workers,
+                                 init_worker, (mapping_path, custom_transformations, worker_mappings(mappings)))
+
+    for _, rows in counted_tasks(results, csv_paths, task_files, records):
+        yield rows
+
+
+def worker_mappings(mappings):
+    # Workers only receive what they need to rebuild the transformations
+    return [dict((name, mapping[name]) for name in WORKER_SETTINGS if name in mapping) for mapping in mappings]
+
+
+def init_shard_worker(mapping_path, custom_transformations, mappings, table_name, shard_dir):
+    global worker_shard
+
+    init_worker(mapping_path, custom_transformations, mappings)
+
+    worker_shard = {
+        'path': os.path.join(shard_dir, '{}.sqlite3'.format(os.getpid())),
+        'table_name': table_name,
+        'mappings': mappings,
+        'db': None,
+    }
+
+
+def shard_database():
+    # Created by the first range, so every shard file belongs to a finished task
+    # even when idle workers are terminated during their start
+    if worker_shard['db'] is None:
+        # Shards are thrown away if anything fails, durability doesn't matter
+        db = worker_shard['db'] = dbutils.connect(worker_shard['path'], 'unsafe')
+
+        # Keys are resolved when shards are merged
+        dbutils.create_table(worker_shard['table_name'], worker_shard['mappings'], True, db)
+
+    return worker_shard['db']
+
+
+def shard_range(n, transform, transform_args):
+    # Writes the rows of the n-th range or file to this worker's shard, with its
+    # own reference tables. Returns the row count and the rejected records
+    db = shard_database()
+    mappings = worker_shard['mappings']
+
+    source = transform(*transform_args)
+
+    fk_mappings, _ = read_key_mappings(source, mappings)
+    rows = patch_csv_data(fk_mappings_to_database(fk_mappings, db), source)
+
+    keys, _ = table_keys(mappings)
+    first_rowid = n * SHARD_ROWS + 1
+    records = [(first_rowid + i,) + tuple(row) for i, row in enumerate(rows)]
+
+    rejected = dbutils.insert_many(worker_shard['table_name'], ['rowid'] + keys, records, db=db)
+
+    return len(records), [(position, error, source[position]) for position, error in rejected]
+
+
+def shard_tasks(csv_paths, csv_has_title_columns, position=None, task_files=None):
+    for n, (func, task) in enumerate(file_tasks(csv_paths, csv_has_title_columns, position, task_files)):
+        yield shard_range, (n, func, task)
+
+
+def import_shards(csv_paths, csv_has_title_columns, mapping_path, custom_transformations, table_name,
+                  mappings, shards, shard_dir, batch_size, import_stats, on_conflict=None, count_conflicts=True,
+                  rejects=None, db=None, position=None):
+    # Every worker process writes the ranges it gets to its own database file.
+    # The files are attached and merged in CSV order once they are all written
+    import_stats.start('shards')
+
+    # Position of the first row of every range, rejected records are found by range and index
+    range_firsts = []
+    row_count = 0
+
+    shard_args = (mapping_path, custom_transformations, worker_mappings(mappings), table_name, shard_dir)
+    task_files = collections.deque()
+    results = parallel.map_tasks(shard_tasks(csv_paths, csv_has_title_columns, position, task_files), shards,
+                                 init_shard_worker, shard_args)
+
+    for first, (rows, rejected) in counted_tasks(results, csv_paths, task_files, rejects.records, itemgetter(0)):
+        range_firsts.append(first)
+        row_count += rows
+
+        for index, error, record in rejected:
+            rejects.write(first + index, record, error)
+
+        import_stats.count('rejected', len(rejected))
+        import_stats.count('rows', rows)
+
+    import_stats.stop(row_count)
+    import_stats.start('merge')
+
+    # Worker processes are gone once map_tasks is exhausted, with their locks
+    schemas = []
+
+    for i, shard_path in enumerate(sorted(glob.glob(os.path.join(shard_dir, '*.sqlite3')))):
+        schemas.append('csv2sqlite_shard_{}'.format(i))
+        dbutils.attach(shard_path, schemas[-1], db)
+
+    keys, pk_positions = table_keys(mappings)
+    pk_columns = [keys[i] for i in pk_positions]
+    rows_before = dbutils.count(table_name, db)
+    rejected = []
+
+    try:
+        for fk_table in fk_tables(mappings).values() if schemas else []:
+            dbutils.merge_references(fk_table, schemas, db)
+
+        if schemas:
+            rejected = dbutils.merge_shards(table_name, keys, fk_tables(mappings), schemas,
+                                            on_conflict, pk_columns, batch_size, db)
+    finally:
+        for schema in schemas:
+            dbutils.detach(schema, db)
+
+    for rowid, error, record in rejected:
+        n, index = divmod(rowid - 1, SHARD_ROWS)
+        rejects.write(range_firsts[n] + index, record, error)
+
+    import_stats.count('rejected', len(rejected))
+
+    if on_conflict and count_conflicts:
+        inserted = dbutils.count(table_name, db) - rows_before
+        duplicates = row_count - import_stats.counters['rejected'] - inserted
+
+        import_stats.count('inserted', inserted)
+        import_stats.count('updated', 0 if on_conflict == 'ignore' else duplicates)
+        import_stats.count('skipped', duplicates if on_conflict == 'ignore' else 0)
+
+    import_stats.stop(row_count)
+    import_stats.count('shards', len(schemas))
+
+
+def available_memory():
+    # MemAvailable includes reclaimable caches, unlike SC_AVPHYS_PAGES
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def estimated_build_size(csv_paths, db_path):
+    size = 0
+
+    for csv_path in csv_paths:
+        ratio = COMPRESSION_RATIO if detect_compression(csv_path) else 1
+        size += os.path.getsize(csv_path) * ratio
+
+    existing = os.path.getsize(db_path) if os.path.exists(db_path) else 0
+
+    return size * DATABASE_SIZE_FACTOR + existing
+
+
+def build_in_memory(args, csv_paths):
+    mode = get_option(args, 'build_in_memory')
+
+    if args.output == ':memory:' or mode == 'never':
+        return False
+
+    if mode == 'auto':
+        available = available_memory()
+        return available is not None and estimated_build_size(csv_paths, args.output) <= available * MEMORY_BUILD_FRACTION
+
+    return True
+
+
+class RejectFile:
+    # Records refused by the database, with their file, line and the error.
+    # Records are given by their position in the import, see InputRecords.
+    # The file is only created once there is something to write
+
+    def __init__(self, path, keys, records, max_errors=None):
+        self.path = path
+        self.keys = keys
+        self.records = records
+        self.max_errors = max_errors
+        self.count = 0
+        self.csv_file = None
+        self.writer = None
+
+    def write(self, position, record, error):
+        if self.writer is None:
+            self.csv_file = open(self.path, mode='w', newline='', encoding='utf-8')
+            self.writer = csv.writer(self.csv_file)
+            self.writer.writerow(['file', 'line', 'error'] + self.keys)
+
+        self.writer.writerow(list(self.records.locate(position)) + [error] + list(record))
+        self.count += 1
 
+        if self.max_errors is not None and self.count > self.max_errors:
+            raise exceptions.TooManyErrors(self.count, self.path)
 
-def print_report(my_args, rows_pre_count, table_name, fk_mappings):
+    def close(self):
+        if self.csv_file:
+            self.csv_file.close()
+
+
+def reject_path(args):
+    return get_option(args, 'reject_file') or os.path.splitext(args.output)[0] + '.rejects.csv'
+
+
+def import_chunks(chunks, table_name, mappings, import_stats=None, before_insert=None,
+                  on_conflict=None, count_conflicts=True, rejects=None, db=None, fk_engine='python'):
+    import_stats = import_stats or stats.ImportStats()
+    # Position of the first row of the chunk in the import
+    first = 0
+
+    for chunk in chunks:
+        import_stats.start('fk_normalization')
+
+        # Rejected records are written as transformed, before ids replace fk values
+        source = chunk
+
+        # The sql engine resolves fk values inside SQLite, through a staging table.
+        # Batches it can't stage go through the python engine
+        staged = False
+
+        if fk_engine == 'sql' and fk_tables(mappings):
+            staged = not dbutils.load_staging(staging_name(table_name), chunk, fk_tables(mappings), db)
+
+            if not staged:
+                # Cached ids miss the values the sql engine added
+                for mapping in mappings:
+                    mapping.pop('fk_ids', None)
+
+        if not staged:
+            # Load fk tables
+            fk_mappings, _ = read_key_mappings(chunk, mappings)
+            fk_patch_data = fk_mappings_to_database(fk_mappings, db)
+
+            # Substitute data with foreign key IDs
+            chunk = patch_csv_data(fk_patch_data, chunk)
+
+        import_stats.stop(len(chunk))
+        import_stats.start('insert')
+
+        # Runs inside the transaction committed with the rows
+        if before_insert:
+            before_insert(chunk)
+
+        # Import result
+        if staged:
+            results, rejected = import_staged(chunk, table_name, mappings, on_conflict, count_conflicts, db)
+        else:
+            results, rejected = import_csv(chunk, table_name, mappings, on_conflict, count_conflicts, db)
+
+        if rejected:
+            import_stats.count('rejected', len(rejected))
+
+        if rejects is not None:
+            for position, error in rejected:
+                rejects.write(first + position, source[position], error)
+
+        first += len(chunk)
+
+        if results:
+            import_stats.count('inserted', results[0])
+            import_stats.count('updated', results[1])
+            import_stats.count('skipped', results[2])
+
+        import_stats.stop(len(chunk))
+        import_stats.count('rows', len(chunk))
+
+
+def print_report(my_args, rows_pre_count, table_name, fk_mappings, file_count=1, counters={}, db=None):
     # TODO: Created or Appended
-    print('Added {} records to database {}'.format(
-        dbutils.count(table_name) - rows_pre_count,
-        ntpath.basename(my_args.output)
+    print('Added {} records to database {}{}'.format(
+        dbutils.count(table_name, db) - rows_pre_count,
+        ntpath.basename(my_args.output),
+        ' from {} files'.format(file_count) if file_count > 1 else ''
     ))
-    print('Options: ({}, {}CSV TITLE COLUMNS)'.format(        
+    if 'inserted' in counters:
+        print('Inserted {}, updated {}, skipped {} records ({} ON CONFLICT)'.format(
+            counters['inserted'], counters['updated'], counters['skipped'],
+            get_option(my_args, 'on_conflict') or 'MAPPING'
+        ))
+    print('Options: ({}, {}CSV TITLE COLUMNS, {} PROFILE)'.format(
         my_args.default_mapping_action.upper(),
-        '' if my_args.csv_has_title_columns else 'NO '
+        '' if my_args.csv_has_title_columns else 'NO ',
+        get_option(my_args, 'profile').upper()
     ))
     print('Database map:')
     print(' {} (MAIN TABLE)'.format(table_name))
@@ -322,6 +1205,15 @@ def print_report(my_args, rows_pre_count, table_name, fk_mappings):
         print('  └─ {} (REFERENCE TABLE)'.format(fk_mapping['column_name']))
     print('')
 
+def report_stats(my_args, import_stats):
+    if get_option(my_args, 'stats'):
+        print(import_stats.summary())
+        print('')
+
+    if get_option(my_args, 'stats_json'):
+        import_stats.write_json(get_option(my_args, 'stats_json'))
+
+
 def print_error(ex):
     errors = {
         FileNotFoundError: lambda: 'File not found: "{}"'.format(ex.filename),
@@ -329,6 +1221,7 @@ def print_error(ex):
         IOError: lambda: 'Unknown error reading file: "{}"'.format(ex.filename),
         json.JSONDecodeError: lambda: 'Mapping file - JSON syntax error ({}:{}): {}'.format(ex.lineno, ex.colno, ex.msg),
         exceptions.CsvColumnNotFound: lambda: 'Mapped column [{}] was not found in CSV file at line {}'.format(ex.column_index, ex.line_number),
+        exceptions.TooManyErrors: lambda: 'Import aborted after {} rejected records, see "{}"'.format(ex.error_count, ex.reject_path),
         Exception: lambda: ex.args[0]
     }
 
@@ -349,55 +1242,366 @@ def csv_to_sqlite3(args):
         
 
 def _csv_to_sqlite3(args):
-    csv_path = args.input
-    mapping_path = args.mapping
-    db_path = args.output
-    csv_has_title_columns = args.csv_has_title_columns
-    default_mapping_action = args.default_mapping_action
-
-    path = ntpath.basename(csv_path)
-    default_table_name = os.path.splitext(path)[0]
-
-    # Load config
-    table_name, custom_transformations, mappings, default_mapping_action = \
-        load_and_process_mapping_config(mapping_path, default_table_name, default_mapping_action)
-    
-    # Clean table name
-    table_name = clean_name(table_name)
+    importer = Importer(args)
+    importer.run()
+    importer.report()
 
-    # Load custom transformations if they exist
-    if custom_transformations:
-        load_custom_transformations(mapping_path, custom_transformations)
+    # Library callers read the imported database through the dbutils functions
+    dbutils.connection = importer.connection
 
-    # Load csv file into a list
-    all_csv_data = csv_read_file(csv_path)
+    return importer
 
-    headers = []
 
-    if csv_has_title_columns:
-        # Remove headers
-        headers = all_csv_data[0]
-        all_csv_data = all_csv_data[1:]
+class Importer:
+    # One import into one database. The connection, mappings and transformations
+    # belong to the instance, separate instances can run in separate threads
+
+    def __init__(self, args, state=None):
+        self.args = args
+        # Connection, plans and fk ids kept between imports into the same database, see service.py
+        self.state = state
+        self.connection = None
+        self.registry = transformation_registry()
+        self.csv_paths = []
+        self.table_name = None
+        self.mappings = None
+        self.fk_mappings = []
+        self.rows_pre_count = 0
+        self.rejects = None
+        self.stats = stats.ImportStats()
+
+    def option(self, name):
+        return get_option(self.args, name)
+
+    def resolve_mappings(self, csv_path, headers, sample):
+        args = self.args
+        mapping_path = args.mapping
+
+        # Load config, the table name is left to the caller when the mapping file has none
+        table_name, custom_transformations, mappings, default_mapping_action = \
+            load_and_process_mapping_config(mapping_path, None, args.default_mapping_action)
+
+        # Load custom transformations if they exist
+        if custom_transformations:
+            load_custom_transformations(mapping_path, custom_transformations, self.registry)
+
+        self.stats.start('inference')
+
+        # Guess column types, unless this header was seen before
+        types = None
+        schema_cache = self.option('schema_cache')
+
+        if schema_cache:
+            types = inference.load_cached_types(csv_path, headers)
+
+        if types is None:
+            types = sample_column_types(csv_path, args.csv_has_title_columns, headers, sample,
+                                        self.option('type_sample'), self.option('type_sample_size'))
+
+            if schema_cache:
+                inference.save_cached_types(csv_path, headers, types)
+
+        self.stats.stop()
+
+        # Set mapping defaults
+        set_mapping_defaults(sample, mappings, headers, default_mapping_action, types, self.registry)
+
+        return table_name, custom_transformations, mappings, load_index_config(mapping_path)
+
+    def run(self):
+        try:
+            return self.load()
+        except BaseException:
+            # The database keeps the journal and locking it had, even half loaded
+            if self.connection:
+                dbutils.abort_load(self.connection)
+
+            raise
+
+    def load(self):
+        args = self.args
+        import_stats = self.stats
+
+        csv_paths = self.csv_paths = expand_inputs(args.input)
+        mapping_path = args.mapping
+        csv_has_title_columns = args.csv_has_title_columns
+
+        if not csv_paths:
+            inputs = [args.input] if isinstance(args.input, str) else args.input
+            raise Exception('No CSV files found: {}'.format(', '.join(inputs)))
+
+        # Every file goes to the same table, the first one decides names and types
+        csv_path = csv_paths[0]
+
+        import_stats.start('setup')
+        import_stats.start('parse')
+
+        # Stream csv rows, only the type guessing sample is kept in memory
+        # Readers keep the position of the input up to date for the byte counts
+        # and the progress line
+        position = {}
+        offsets, _ = progress.file_offsets(csv_paths)
+
+        def bytes_read():
+            # Incremental imports skip what earlier runs imported
+            return progress.bytes_consumed(offsets, position) - position.get('skipped', 0)
+
+        if self.option('progress'):
+            import_stats.progress = progress.ProgressReporter(csv_paths, position)
+
+        # File and line of every record, for the reject file
+        records = InputRecords(csv_has_title_columns)
+
+        csv_rows = csv_iter_file(csv_path, csv_has_title_columns, position, records)
+
+        headers = []
+
+        if csv_has_title_columns:
+            # Remove headers
+            headers = next(csv_rows, [])
+
+        sample_size = self.option('type_sample_size')
+        sample = list(itertools.islice(csv_rows, sample_size))
+
+        import_stats.stop()
+
+        # Mappings resolved for the same mapping file, transformations and title columns are reused
+        plan = None
+        registry = self.registry
+        mapping_cache = self.option('mapping_cache')
+
+        # Plans kept in memory come with their transformations
+        plans = None if self.state is None else self.state.setdefault('plans', {})
+
+        if mapping_cache or plans is not None:
+            plan_key = mappingcache.plan_key(mapping_path, headers, len(sample[0]) if sample else 0, [
+                args.default_mapping_action, self.option('type_sample'), sample_size])
+
+        if plans is not None and plan_key in plans:
+            plan, registry = plans[plan_key]
+            plan = mappingcache.check_plan(plan, mapping_path)
+
+        if plan is None and mapping_cache:
+            registry = self.registry
+            plan = mappingcache.load_plan(csv_path, plan_key, mapping_path)
+
+            if plan and plan['custom_transformations']:
+                load_custom_transformations(mapping_path, plan['custom_transformations'], registry)
+
+        if plan is None:
+            table_name, custom_transformations, mappings, index_config = \
+                self.resolve_mappings(csv_path, headers, sample)
+
+            if mapping_cache or plans is not None:
+                plan = mappingcache.make_plan(mapping_path, table_name, custom_transformations, mappings, index_config)
+
+            if mapping_cache:
+                mappingcache.save_plan(csv_path, plan_key, plan)
+        else:
+            table_name, custom_transformations, index_config = \
+                plan['table_name'], plan['custom_transformations'], plan['indexes']
+            mappings = mappingcache.resolve_mappings(plan, registry)
+            self.registry = registry
+
+            import_stats.count('mapping_cache_hits')
+
+        if plans is not None:
+            plans[plan_key] = (plan, registry)
+
+        # Clean table name
+        table_name = self.table_name = clean_name(table_name or default_table_name(csv_path))
+        self.mappings = mappings
+
+        # The whole database is built in memory and written out once, when it fits
+        in_memory = build_in_memory(args, csv_paths)
+
+        kept = None if self.state is None else self.state.pop('connection', None)
+
+        # A kept connection can't follow a database file replaced or removed since
+        if kept and (in_memory or not os.path.exists(args.output)):
+            kept.close()
+            kept = None
+
+        if in_memory:
+            db = self.connection = dbutils.connect_in_memory(args.output, self.option('profile'))
+        elif kept:
+            db = self.connection = kept
+            dbutils.start_load(self.option('profile'), db=db)
+        else:
+            db = self.connection = dbutils.connect(args.output, self.option('profile'))
+
+        if self.state is not None and not in_memory:
+            self.state['connection'] = db
+
+        # Memory for fk ids is split evenly between the reference tables
+        fk_max_memory = self.option('fk_max_memory')
+        fk_mappings = [mapping for mapping in mappings if mapping.get('key') == 'fk']
+
+        for mapping in fk_mappings if fk_max_memory else []:
+            mapping['fk_cache'] = fkcache.FkCache(int(fk_max_memory * 1024 * 1024 / len(fk_mappings)))
+
+        # Create database table, a new table may get its key after loading. Only
+        # a conflict mode says which row of a duplicated key to keep, without
+        # one the key is there from the start and duplicates are rejected
+        on_conflict = conflict_mode(args, mappings)
+        defer_pk = self.option('defer_indexes') and on_conflict is not None
+        defer_pk = dbutils.create_table(table_name, mappings, defer_pk, db) and defer_pk
+        self.rows_pre_count = dbutils.count(table_name, db)
+
+        # Indexes are built in one sorted pass instead of being maintained by every insert,
+        # except unique ones: duplicate rows are rejected by the database as they come
+        indexes = table_indexes(mappings, index_config, defer_pk, self.option('fk_indexes'))
+
+        if defer_pk:
+            indexes[0]['keep'] = 'last' if on_conflict in ['replace', 'update'] else 'first'
+
+        dbutils.create_indexes(table_name, [index for index in indexes if index['unique'] and 'keep' not in index], db)
+
+        import_stats.stop()
+
+        batch_size = self.option('batch_size')
+        workers = self.option('workers') or parallel.cpu_count()
+        before_insert = None
+
+        # Worker processes write separate database files, all attached to this one to be merged
+        shards = min(self.option('shards'), dbutils.max_attached(db))
+        sharded = shards > 1 and not self.option('incremental') and \
+            (len(csv_paths) > 1 or detect_compression(csv_path) is None)
+
+        # Ids of reference values stay loaded between imports of the python engine,
+        # the other ways of writing change reference tables behind them
+        fk_ids = None if self.state is None else self.state.setdefault('fk_ids', {})
+        warm_fk = fk_ids is not None and not sharded and not fk_max_memory and self.option('fk_engine') == 'python'
+
+        for mapping in fk_mappings if warm_fk else []:
+            if mapping['column_name'] in fk_ids:
+                mapping['fk_ids'] = fk_ids[mapping['column_name']]
+
+        if fk_ids and not warm_fk:
+            fk_ids.clear()
+
+        # A reader thread parses and transforms while this thread writes, the
+        # checkpoints of incremental imports must follow the written rows
+        queue_size = 0 if self.option('incremental') or sharded else self.option('queue_size')
+        reader_stats = stats.ImportStats() if queue_size else import_stats
+
+        if self.option('incremental'):
+            # Rows are read from the last checkpoint of every file, in this thread
+            csv_rows.close()
+            records = InputRecords(csv_has_title_columns)
+            checkpoint = {}
+            chunks = incremental_chunks(csv_paths, table_name, csv_has_title_columns, batch_size, checkpoint, db,
+                                        position, records)
+            chunks = import_stats.timed_chunks('parse', chunks, bytes_read)
+            chunks = import_stats.timed_chunks('transform', transform_chunks(chunks, mappings))
+
+            def before_insert(chunk):
+                dbutils.save_checkpoint(checkpoint['source'], table_name, checkpoint['byte_offset'],
+                                        checkpoint['row_count'], checkpoint['fingerprint'], db)
+        elif sharded:
+            # Worker processes read the files, see import_shards
+            csv_rows.close()
+            records = InputRecords(csv_has_title_columns)
+        elif workers > 1 and (len(csv_paths) > 1 or detect_compression(csv_path) is None):
+            # Workers parse and transform byte ranges or whole files, this process only writes
+            csv_rows.close()
+            records = InputRecords(csv_has_title_columns)
+            ranges = parallel_transform_chunks(csv_paths, csv_has_title_columns, mapping_path,
+                                               custom_transformations, mappings, workers, records, position)
+            chunks = chunked(itertools.chain.from_iterable(ranges), batch_size)
+            chunks = reader_stats.timed_chunks('workers', chunks, bytes_read)
+        else:
+            other_rows = (csv_data_rows(path, csv_has_title_columns, position, records) for path in csv_paths[1:])
+            csv_rows = itertools.chain(sample, csv_rows, itertools.chain.from_iterable(other_rows))
+            chunks = chunked(csv_rows, batch_size)
+            chunks = reader_stats.timed_chunks('parse', chunks, bytes_read)
+            chunks = reader_stats.timed_chunks('transform', transform_chunks(chunks, mappings))
+
+        if queue_size:
+            reader = parallel.read_ahead(chunks, queue_size, reader_stats)
+            chunks = import_stats.timed_chunks('writer_idle', reader)
+
+        # Normalize and insert one batch at a time
+        # Without a key index during the load, duplicates are resolved when it's built
+        rejects = self.rejects = RejectFile(reject_path(args), [mapping['column_name'] for mapping in mappings],
+                                            records, self.option('max_errors'))
+
+        # A deferred key has nothing to conflict with while loading, rows are
+        # inserted as they come and create_indexes keeps the first or last one
+        load_conflict = None if defer_pk else on_conflict
+
+        try:
+            if sharded:
+                shard_dir = tempfile.mkdtemp('.csv2sqlite-shards', dir=os.path.dirname(os.path.abspath(args.output)))
+
+                try:
+                    import_shards(csv_paths, csv_has_title_columns, mapping_path, custom_transformations,
+                                  table_name, mappings, shards, shard_dir, batch_size, import_stats, load_conflict,
+                                  not defer_pk, rejects, db, position)
+                finally:
+                    shutil.rmtree(shard_dir, ignore_errors=True)
+            else:
+                import_chunks(chunks, table_name, mappings, import_stats, before_insert,
+                              load_conflict, not defer_pk, rejects, db, self.option('fk_engine'))
+        finally:
+            rejects.close()
+
+            # Stops the reader thread when the writer fails
+            if queue_size:
+                reader.close()
+                import_stats.merge(reader_stats)
+
+        for mapping in fk_mappings if warm_fk else []:
+            if 'fk_ids' in mapping:
+                fk_ids[mapping['column_name']] = mapping['fk_ids']
+
+        self.fk_mappings, _ = read_key_mappings([], mappings)
+
+        import_stats.start('indexes')
+
+        duplicates = dbutils.create_indexes(table_name, indexes, db)
+
+        if defer_pk:
+            import_stats.count('inserted', import_stats.counters.get('rows', 0)
+                               - import_stats.counters.get('rejected', 0) - duplicates)
+            import_stats.count('updated', 0 if on_conflict == 'ignore' else duplicates)
+            import_stats.count('skipped', duplicates if on_conflict == 'ignore' else 0)
+
+        import_stats.stop()
+
+        # Put back the journal the database had so other connections can use it
+        import_stats.timed('finish', dbutils.finish_load, db)
+
+        import_stats.count('bytes', bytes_read())
+        import_stats.count('files', len(csv_paths))
+        import_stats.counters.update(dbutils.counters(db))
+
+        for mapping in fk_mappings if fk_max_memory else []:
+            import_stats.count('fk_cache_hits', mapping['fk_cache'].hits)
+            import_stats.count('fk_cache_misses', mapping['fk_cache'].misses)
+            import_stats.count('fk_cache_evictions', mapping['fk_cache'].evictions)
 
-    dbutils.create_and_connect(db_path)
+        if in_memory:
+            self.connection = import_stats.timed('backup', dbutils.save_to_disk, db, args.output)
 
-    # Set mapping defaults
-    set_mapping_defaults(all_csv_data, mappings, headers, default_mapping_action)
+        import_stats.finish()
+        import_stats.notify()
 
-    all_csv_data = csv_transform(all_csv_data, mappings)
+        if import_stats.progress:
+            import_stats.progress.finish(import_stats.counters.get('rows', 0))
 
-    # Create database table
-    dbutils.create_table(table_name, mappings)
-    rows_pre_count = dbutils.count(table_name)
+        return import_stats
 
-    # Load fk tables
-    fk_mappings, _ = read_key_mappings(all_csv_data, mappings)
-    fk_patch_data = fk_mappings_to_database(fk_mappings)
+    def report(self):
+        print_report(self.args, self.rows_pre_count, self.table_name, self.fk_mappings,
+                     len(self.csv_paths), self.stats.counters, self.connection)
 
-    # Substitute data with foreign key IDs
-    patch_csv_data(fk_patch_data, all_csv_data)
+        if self.rejects.count:
+            print('Rejected {} records, written to {}'.format(self.rejects.count, self.rejects.path))
 
-    # Import result
-    import_csv(all_csv_data, table_name, mappings)
+        report_stats(self.args, self.stats)
 
-    print_report(args, rows_pre_count, table_name, fk_mappings)
+    def close(self):
+        # A kept connection belongs to the state
+        if self.connection and (self.state is None or self.state.get('connection') is not self.connection):
+            self.connection.close()
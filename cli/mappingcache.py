@@ -0,0 +1,99 @@
+import os
+import json
+import hashlib
+
+
+CACHE_FILE_NAME = '.csv2sqlite-mappings.json'
+
+# Changes whenever the stored plan changes shape, older entries are ignored
+PLAN_VERSION = 1
+
+# Keys of a resolved mapping that are not JSON, rebuilt when a plan is loaded
+RESOLVED_KEYS = ['transform']
+
+
+def file_hash(path):
+    with open(path, 'rb') as data_file:
+        return hashlib.sha1(data_file.read()).hexdigest()
+
+
+def plan_key(mapping_path, headers, column_count, options):
+    # Files without title columns are told apart by their number of columns only
+    parts = [
+        str(PLAN_VERSION),
+        file_hash(mapping_path) if mapping_path else '',
+        '\x1f'.join(headers) if headers else str(column_count),
+    ]
+    parts.extend(str(option) for option in options)
+
+    return hashlib.sha1('\x1e'.join(parts).encode('utf-8')).hexdigest()
+
+
+def transformations_path(mapping_path, custom_transformations):
+    # Same resolution as load_custom_transformations, relative to the mapping file
+    return os.path.join(os.path.abspath(os.path.dirname(mapping_path)), custom_transformations)
+
+
+def cache_path(csv_path):
+    return os.path.join(os.path.dirname(os.path.abspath(csv_path)), CACHE_FILE_NAME)
+
+
+def read_cache(path):
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as cache_file:
+        try:
+            return json.load(cache_file)
+        except ValueError:
+            return {}
+
+
+def make_plan(mapping_path, table_name, custom_transformations, mappings, indexes):
+    plan = {
+        'table_name': table_name,
+        'custom_transformations': custom_transformations,
+        'mappings': [dict((key, value) for key, value in mapping.items() if key not in RESOLVED_KEYS)
+                     for mapping in mappings],
+        'indexes': indexes,
+    }
+
+    if custom_transformations:
+        plan['transformations_hash'] = file_hash(transformations_path(mapping_path, custom_transformations))
+
+    return plan
+
+
+def check_plan(plan, mapping_path):
+    if plan is None or not plan['custom_transformations']:
+        return plan
+
+    # An edited transformations module invalidates the plans using it
+    path = transformations_path(mapping_path, plan['custom_transformations'])
+
+    if not os.path.exists(path) or file_hash(path) != plan['transformations_hash']:
+        return None
+
+    return plan
+
+
+def load_plan(csv_path, key, mapping_path):
+    return check_plan(read_cache(cache_path(csv_path)).get(key), mapping_path)
+
+
+def save_plan(csv_path, key, plan):
+    path = cache_path(csv_path)
+    cache = read_cache(path)
+    cache[key] = plan
+
+    with open(path, 'w') as cache_file:
+        json.dump(cache, cache_file, indent=4)
+
+
+def resolve_mappings(plan, registry):
+    mappings = [dict(mapping) for mapping in plan['mappings']]
+
+    for mapping in mappings:
+        mapping['transform'] = registry[mapping['transform_name']] if 'transform_name' in mapping else None
+
+    return mappings
@@ -0,0 +1,167 @@
+import os
+import queue
+import threading
+import collections
+import multiprocessing
+
+
+# Approximate amount of CSV bytes handed to a worker at a time
+RANGE_SIZE = 8 * 1024 * 1024
+
+BLOCK_SIZE = 1024 * 1024
+
+# Seconds between checks for a consumer that stopped reading
+PUT_TIMEOUT = 0.1
+
+# Marks the end of the items of read_ahead
+DONE = object()
+
+
+def iter_row_ranges(csv_path, start=0, range_size=RANGE_SIZE, quotechar=b'"'):
+    # A newline only ends a row when it's preceded by an even number of
+    # quote characters, escaped quotes ("") always come in pairs
+    range_start = pos = start
+    target = range_start + range_size
+    quotes = 0
+
+    with open(csv_path, mode='rb') as csv_file:
+        csv_file.seek(start)
+
+        while True:
+            block = csv_file.read(BLOCK_SIZE)
+
+            if not block:
+                break
+
+            k = 0
+
+            while True:
+                offset = target - pos
+
+                if offset >= len(block):
+                    quotes += block.count(quotechar, k)
+                    break
+
+                offset = max(offset, k)
+                quotes += block.count(quotechar, k, offset)
+                k = offset
+
+                i = block.find(b'\n', k)
+                found = False
+
+                while i != -1:
+                    quotes += block.count(quotechar, k, i)
+                    k = i
+
+                    if quotes % 2 == 0:
+                        boundary = pos + i + 1
+
+                        yield range_start, boundary
+
+                        range_start = boundary
+                        target = boundary + range_size
+                        quotes = 0
+                        k = i + 1
+                        found = True
+                        break
+
+                    i = block.find(b'\n', i + 1)
+
+                if not found:
+                    quotes += block.count(quotechar, k)
+                    break
+
+            pos += len(block)
+
+    if range_start < pos:
+        yield range_start, pos
+
+
+def first_row_end(csv_path):
+    for _, end in iter_row_ranges(csv_path, 0, 1):
+        return end
+
+    return 0
+
+
+def imap_bounded(pool, tasks, window):
+    # Like Pool.imap, but never has more than `window` results in flight.
+    # Every task is a (function, arguments) pair
+    pending = collections.deque()
+
+    for func, task in tasks:
+        pending.append(pool.apply_async(func, task))
+
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def range_tasks(csv_path, start, func):
+    for range_start, range_end in iter_row_ranges(csv_path, start):
+        yield func, (csv_path, range_start, range_end)
+
+
+def map_tasks(tasks, workers, initializer=None, initargs=()):
+    with multiprocessing.Pool(workers, initializer, initargs) as pool:
+        for result in imap_bounded(pool, tasks, workers * 2):
+            yield result
+
+
+def read_ahead(items, queue_size, import_stats=None):
+    # Produces items in a thread while the caller consumes them, at most
+    # queue_size items ahead. Time the thread waits for room is charged to
+    # the reader_idle stage of import_stats
+    ready = queue.Queue(queue_size)
+    stopped = threading.Event()
+
+    def put(entry):
+        if import_stats:
+            import_stats.start('reader_idle')
+
+        try:
+            while not stopped.is_set():
+                try:
+                    ready.put(entry, timeout=PUT_TIMEOUT)
+                    return True
+                except queue.Full:
+                    pass
+
+            return False
+        finally:
+            if import_stats:
+                import_stats.stop()
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+
+            put((DONE, None))
+        except BaseException as e:
+            put((None, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = ready.get()
+
+            if error is not None:
+                raise error
+
+            if item is DONE:
+                return
+
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def cpu_count():
+    return os.cpu_count() or 1
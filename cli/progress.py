@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+
+
+# Seconds between updates of the terminal line, and between log lines otherwise
+TTY_INTERVAL = 0.5
+LOG_INTERVAL = 10
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+
+
+def file_offsets(csv_paths):
+    # Bytes of the files before every file, and of all of them
+    offsets = {}
+    total = 0
+
+    for csv_path in csv_paths:
+        offsets[csv_path] = total
+        total += os.path.getsize(csv_path)
+
+    return offsets, total
+
+
+def bytes_consumed(offsets, position):
+    # Bytes of the input read so far, `position` as kept by the readers
+    path = position.get('path')
+
+    if path is None:
+        return 0
+
+    try:
+        return offsets[path] + position['tell']()
+    except ValueError:
+        # Closed files were read to the end
+        return offsets[path] + os.path.getsize(path)
+
+
+class ProgressReporter:
+    # Readers keep `position` up to date: 'path' is the file being read and
+    # 'tell' returns the bytes of it consumed so far, compressed bytes for
+    # compressed files. Between two updates a call only reads the clock
+
+    def __init__(self, csv_paths, position, stream=None, interval=None):
+        self.position = position
+        self.stream = stream or sys.stderr
+        self.tty = self.stream.isatty()
+        self.interval = interval or (TTY_INTERVAL if self.tty else LOG_INTERVAL)
+
+        self.offsets, self.total = file_offsets(csv_paths)
+
+        self.started = time.perf_counter()
+        self.next_update = self.started + self.interval
+        self.last_line = ''
+
+    def line(self, now, stage, rows):
+        elapsed = now - self.started
+        consumed = bytes_consumed(self.offsets, self.position)
+
+        # Incremental imports skip what earlier runs imported, rates only count this run
+        byte_rate = (consumed - self.position.get('skipped', 0)) / elapsed if elapsed else 0
+        eta = format_duration((self.total - consumed) / byte_rate) if byte_rate > 0 else '-'
+
+        return '{:5.1f}% {:,.1f}/{:,.1f} MB, {:,} rows, {:,.0f} rows/s, {:.1f} MB/s, {}, ETA {}'.format(
+            consumed / self.total * 100 if self.total else 100, consumed / 1024 / 1024, self.total / 1024 / 1024,
+            rows, rows / elapsed if elapsed else 0, byte_rate / 1024 / 1024, stage or '-', eta)
+
+    def update(self, stage, rows, force=False):
+        now = time.perf_counter()
+
+        if now < self.next_update and not force:
+            return
+
+        self.next_update = now + self.interval
+        line = self.line(now, stage, rows)
+
+        if self.tty:
+            # Pads over the end of a longer previous line
+            self.stream.write('\r' + line.ljust(len(self.last_line)))
+        else:
+            self.stream.write(line + '\n')
+
+        self.stream.flush()
+        self.last_line = line
+
+    def finish(self, rows):
+        self.update('done', rows, True)
+
+        if self.tty:
+            self.stream.write('\n')
+            self.stream.flush()
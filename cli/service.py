@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import signal
+import argparse
+import threading
+import collections
+import socketserver
+
+import libcsv2sqlite
+
+
+# Seconds between two scans of the spool directory
+POLL_INTERVAL = 1.0
+
+# Latencies of the most recent jobs, kept for the status
+LATENCY_WINDOW = 1000
+
+# Spooled files are moved to these subdirectories once imported
+DONE_DIR = 'done'
+FAILED_DIR = 'failed'
+
+STOP = object()
+
+
+def percentile(values, share):
+    if not values:
+        return None
+
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def job_args(defaults, options):
+    # Options of a job override the ones the service was started with
+    values = dict(vars(defaults))
+    values.update(options)
+
+    return argparse.Namespace(**values)
+
+
+class Service:
+    # Imports jobs with a pool of threads. Every database always goes to the
+    # same thread, which keeps its connection, mapping plans and fk ids
+    # between jobs: SQLite connections can't move between threads, and one
+    # database only takes one writer at a time anyway
+
+    def __init__(self, args, workers=1):
+        self.args = args
+        self.queues = [queue.Queue() for i in range(0, workers)]
+        self.threads = []
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.counters = {'jobs': 0, 'failed': 0, 'rows': 0}
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.waits = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def start(self):
+        for jobs in self.queues:
+            thread = threading.Thread(target=self.work, args=(jobs,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, options, done=None):
+        # `done` is called from the worker thread with the result of the job
+        args = job_args(self.args, options)
+        jobs = self.queues[hash(os.path.abspath(args.output)) % len(self.queues)]
+
+        with self.lock:
+            self.queued += 1
+
+        jobs.put({'args': args, 'done': done, 'queued': time.perf_counter()})
+
+    def stop(self):
+        # Jobs queued so far are imported first
+        for jobs in self.queues:
+            jobs.put(STOP)
+
+        for thread in self.threads:
+            thread.join()
+
+    def work(self, jobs):
+        states = {}
+
+        try:
+            while True:
+                job = jobs.get()
+
+                if job is STOP:
+                    return
+
+                self.run_job(job, states)
+        finally:
+            for state in states.values():
+                close_state(state)
+
+    def run_job(self, job, states):
+        args = job['args']
+        state = states.setdefault(os.path.abspath(args.output), {})
+        started = time.perf_counter()
+
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+
+        result = {'input': args.input, 'output': args.output, 'wait': started - job['queued']}
+
+        importer = libcsv2sqlite.Importer(args, state)
+
+        try:
+            import_stats = importer.run()
+
+            result['status'] = 'ok'
+            result['rows'] = import_stats.counters.get('rows', 0)
+            result['rejected'] = import_stats.counters.get('rejected', 0)
+        except Exception as e:
+            # Ids and transactions of a failed import can't be trusted, the next job starts cold
+            close_state(states.pop(os.path.abspath(args.output)))
+
+            result['status'] = 'error'
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+        finally:
+            importer.close()
+
+        finished = time.perf_counter()
+        result['time'] = finished - started
+        result['latency'] = finished - job['queued']
+
+        with self.lock:
+            self.running -= 1
+            self.counters['jobs'] += 1
+            self.counters['failed'] += result['status'] != 'ok'
+            self.counters['rows'] += result.get('rows', 0)
+            self.latencies.append(result['latency'])
+            self.waits.append(result['wait'])
+
+        if job['done']:
+            job['done'](result)
+
+    def status(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            waits = list(self.waits)
+            status = dict(self.counters)
+            status['queued'] = self.queued
+            status['running'] = self.running
+
+        status['latency_p50'] = percentile(latencies, 0.5)
+        status['latency_p95'] = percentile(latencies, 0.95)
+        status['latency_max'] = max(latencies) if latencies else None
+        status['wait_p50'] = percentile(waits, 0.5)
+
+        return status
+
+
+def close_state(state):
+    if state.get('connection'):
+        state['connection'].close()
+
+
+def log_job(service, result):
+    input_paths = [result['input']] if isinstance(result['input'], str) else result['input']
+
+    if result['status'] == 'ok':
+        outcome = '{:,} rows'.format(result['rows'])
+    else:
+        outcome = 'failed, {}'.format(result['error'])
+
+    print('{} -> {}: {} in {:.3f} s, waited {:.3f} s, {} queued'.format(
+        ', '.join(input_paths), result['output'], outcome, result['time'], result['wait'],
+        service.status()['queued']))
+    sys.stdout.flush()
+
+
+def scan_spool(service, spool_dir, pending):
+    # Files are picked up once they show under their final name, writers
+    # should create them with a leading dot and rename them when complete
+    failed_dir = os.path.join(spool_dir, FAILED_DIR)
+    os.makedirs(failed_dir, exist_ok=True)
+
+    for csv_path in libcsv2sqlite.expand_inputs(spool_dir):
+        if csv_path in pending:
+            continue
+
+        pending.add(csv_path)
+
+        def done(result, csv_path=csv_path):
+            log_job(service, result)
+
+            target = os.path.join(spool_dir, DONE_DIR if result['status'] == 'ok' else FAILED_DIR)
+            os.makedirs(target, exist_ok=True)
+            shutil.move(csv_path, os.path.join(target, os.path.basename(csv_path)))
+
+            if result['status'] != 'ok':
+                with open(os.path.join(target, os.path.basename(csv_path) + '.error'), 'w') as error_file:
+                    error_file.write(result['error'] + '\n')
+
+            pending.discard(csv_path)
+
+        # Every file gets its own reject file
+        service.submit({
+            'input': [csv_path],
+            'reject_file': os.path.join(failed_dir, os.path.basename(csv_path) + '.rejects.csv'),
+        }, done)
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    # One JSON object per line: import options, with at least "input", or
+    # {"command": "status"}. Every line gets a JSON line back, imports once done
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                self.reply({'status': 'error', 'error': 'Invalid JSON: {}'.format(e)})
+                continue
+
+            if request.get('command') == 'status':
+                self.reply(self.server.service.status())
+                continue
+
+            if 'input' not in request:
+                self.reply({'status': 'error', 'error': 'Jobs need an "input"'})
+                continue
+
+            results = queue.Queue(1)
+            self.server.service.submit(request, results.put)
+            result = results.get()
+
+            log_job(self.server.service, result)
+            self.reply(result)
+
+    def reply(self, data):
+        self.wfile.write((json.dumps(data) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, service):
+        self.service = service
+
+        # Left behind by a service that didn't stop cleanly
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        super().__init__(socket_path, JobHandler)
+
+
+def serve(args):
+    service = Service(args, args.service_workers)
+    service.start()
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    server = None
+
+    if args.socket:
+        server = JobServer(args.socket, service)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    print('Serving{}{}, {} workers'.format(
+        ' spool directory {}'.format(args.spool_dir) if args.spool_dir else '',
+        ' socket {}'.format(args.socket) if args.socket else '',
+        len(service.queues)))
+    sys.stdout.flush()
+
+    pending = set()
+
+    try:
+        while not stopping.is_set():
+            if args.spool_dir:
+                scan_spool(service, args.spool_dir, pending)
+
+            stopping.wait(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+            os.remove(args.socket)
+
+        service.stop()
+
+    print('Stopped: {}'.format(json.dumps(service.status())))
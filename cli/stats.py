@@ -0,0 +1,194 @@
+import sys
+import json
+import time
+import resource
+
+
+# Callbacks receiving ImportStats.as_dict() after every import
+hooks = []
+
+
+def register_hook(callback):
+    hooks.append(callback)
+
+
+def unregister_hook(callback):
+    hooks.remove(callback)
+
+
+def peak_memory_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+class ImportStats:
+    # Stages can be nested, only the innermost running stage accumulates time
+
+    def __init__(self, progress=None):
+        # A progress.ProgressReporter, told about every stage and row count
+        self.progress = progress
+        self.stages = {}
+        self.stack = []
+        self.counters = {}
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+        self.finished = None
+        self.finished_cpu = None
+
+    def _stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'wall': 0.0, 'cpu': 0.0, 'rows': 0, 'bytes': 0}
+
+        return self.stages[name]
+
+    def _charge_top(self, now, now_cpu):
+        if self.stack:
+            name, since, since_cpu = self.stack[-1]
+            stage = self._stage(name)
+            stage['wall'] += now - since
+            stage['cpu'] += now_cpu - since_cpu
+
+    def start(self, name):
+        now, now_cpu = time.perf_counter(), time.process_time()
+
+        self._charge_top(now, now_cpu)
+        self.stack.append((name, now, now_cpu))
+
+        if self.progress:
+            self.progress.update(name, self.counters.get('rows', 0))
+
+    def stop(self, rows=0, bytes=0):
+        now, now_cpu = time.perf_counter(), time.process_time()
+
+        self._charge_top(now, now_cpu)
+        name, _, _ = self.stack.pop()
+
+        stage = self._stage(name)
+        stage['rows'] += rows
+        stage['bytes'] += bytes
+
+        # The parent stage resumes from here
+        if self.stack:
+            parent, _, _ = self.stack.pop()
+            self.stack.append((parent, now, now_cpu))
+
+    def timed(self, name, function, *args):
+        self.start(name)
+
+        try:
+            return function(*args)
+        finally:
+            self.stop()
+
+    def timed_chunks(self, name, chunks, read=None):
+        # Charges the time spent producing every chunk to `name`, with the
+        # bytes read() went on by when given
+        iterator = iter(chunks)
+        read_before = 0
+
+        while True:
+            self.start(name)
+
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                self.stop()
+                return
+            except BaseException:
+                self.stop()
+                raise
+
+            read_after = read() if read else 0
+            self.stop(len(chunk), read_after - read_before)
+            read_before = read_after
+
+            yield chunk
+
+    def merge(self, other):
+        # Adds the stages and counters of stats kept by another thread
+        for name, stage in other.stages.items():
+            for key, value in stage.items():
+                self._stage(name)[key] += value
+
+        for name, value in other.counters.items():
+            self.count(name, value)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+        if name == 'rows' and self.progress and self.stack:
+            self.progress.update(self.stack[-1][0], self.counters['rows'])
+
+    def finish(self):
+        self.finished = time.perf_counter()
+        self.finished_cpu = time.process_time()
+        self.counters['peak_memory_kb'] = peak_memory_kb()
+
+    def as_dict(self):
+        finished = self.finished or time.perf_counter()
+        finished_cpu = self.finished_cpu or time.process_time()
+
+        stages = {}
+
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage)
+            stages[name]['rows_per_second'] = stage['rows'] / stage['wall'] if stage['wall'] and stage['rows'] else None
+            stages[name]['bytes_per_second'] = stage['bytes'] / stage['wall'] if stage['wall'] and stage['bytes'] else None
+
+        wall = finished - self.started
+
+        return {
+            'wall': wall,
+            'cpu': finished_cpu - self.started_cpu,
+            'rows_per_second': self.counters.get('rows', 0) / wall if wall else None,
+            'bytes_per_second': self.counters.get('bytes', 0) / wall if wall else None,
+            'stages': stages,
+            'counters': dict(self.counters),
+        }
+
+    def summary(self):
+        data = self.as_dict()
+        lines = ['Import statistics:']
+
+        lines.append(' {:<20}{:>10}{:>10}{:>12}{:>14}'.format('stage', 'wall s', 'cpu s', 'rows', 'rows/s'))
+
+        for name, stage in data['stages'].items():
+            rate = '{:,.0f}'.format(stage['rows_per_second']) if stage['rows_per_second'] else '-'
+            lines.append(' {:<20}{:>10.3f}{:>10.3f}{:>12,}{:>14}'.format(
+                name, stage['wall'], stage['cpu'], stage['rows'], rate))
+
+        lines.append(' {:<20}{:>10.3f}{:>10.3f}{:>12,}{:>14}'.format(
+            'total', data['wall'], data['cpu'], data['counters'].get('rows', 0),
+            '{:,.0f}'.format(data['rows_per_second']) if data['rows_per_second'] else '-'))
+
+        counters = data['counters']
+
+        lines.append(' {:.1f} MB read at {:.1f} MB/s, peak memory {:,} KB'.format(
+            counters.get('bytes', 0) / 1024 / 1024, (data['bytes_per_second'] or 0) / 1024 / 1024,
+            counters.get('peak_memory_kb', 0)))
+        lines.append(' {:,} SQLite statements, {:,} rows written, {:,} commits'.format(
+            counters.get('statements', 0), counters.get('rows_written', 0), counters.get('commits', 0)))
+
+        if 'reader_idle' in data['stages']:
+            lines.append(' reader idle {:.3f} s with a full queue, writer idle {:.3f} s with an empty one'.format(
+                data['stages']['reader_idle']['wall'], data['stages'].get('writer_idle', {}).get('wall', 0)))
+
+        if 'fk_cache_hits' in counters:
+            lookups = counters['fk_cache_hits'] + counters['fk_cache_misses']
+            lines.append(' FK cache hit rate {:.1%}, {:,} misses, {:,} evictions'.format(
+                counters['fk_cache_hits'] / lookups if lookups else 0, counters['fk_cache_misses'],
+                counters['fk_cache_evictions']))
+
+        return '\n'.join(lines)
+
+    def write_json(self, path):
+        with open(path, 'w') as json_file:
+            json.dump(self.as_dict(), json_file, indent=4)
+
+    def notify(self):
+        data = self.as_dict()
+
+        for callback in hooks:
+            callback(data)
@@ -1,3 +1,28 @@
+import os
+import io
+import sqlite3
+import sys
+import bz2
+import gzip
+import csv
+import json
+import lzma
+import shutil
+import socket
+import zipfile
+import datetime
+import itertools
+import threading
+import parallel
+import benchmark
+import inference
+import service
+import mappingcache
+import fastcsv
+import fkcache
+import stats
+import progress
+import exceptions
 import libcsv2sqlite
 import dbutils
 import unittest
@@ -62,6 +87,757 @@ class MappingTestForeignKey(unittest.TestCase):
         self.assertEqual(dbutils.count('person'), 4)
 
 
+class BatchedImportTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.args = Objectifier({
+            'input': 'test/test2.csv',
+            'mapping': 'test/test2.json',
+            'output': 'tmp/test2_batched.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+            'batch_size': 1,
+        })
+
+    @classmethod
+    def tearDownClass(cls):
+        dbutils.connection.close()
+        dbutils.delete_database(cls.args.output)
+
+    def test_chunked(self):
+        chunks = list(libcsv2sqlite.chunked(range(0, 5), 2))
+
+        self.assertEqual(chunks, [[0, 1], [2, 3], [4]])
+
+    def test_csv_to_sqlite3(self):
+        libcsv2sqlite.csv_to_sqlite3(self.args)
+
+        self.assertEqual(dbutils.count('person'), 4)
+        self.assertEqual(dbutils.count('bombom'), 3)
+
+
+class ForeignKeyResolutionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.args = Objectifier({
+            'input': 'test/test2.csv',
+            'mapping': 'test/test2.json',
+            'output': 'tmp/test2_fk.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+            'batch_size': 2,
+        })
+
+        libcsv2sqlite.csv_to_sqlite3(cls.args)
+
+    @classmethod
+    def tearDownClass(cls):
+        dbutils.connection.close()
+        dbutils.delete_database(cls.args.output)
+
+    def test_reference_values(self):
+        genders = [row['value'] for row in dbutils.select_all('gender', ['id', 'value'])]
+
+        self.assertEqual(sorted(genders), ['female', 'male'])
+
+    def test_patched_ids(self):
+        fk_ids = dict(dbutils.select_id_map('gender'))
+        people = dbutils.select_all('person', ['name', 'gender_id'])
+
+        for person in people:
+            expected = 'male' if person['name'] == 'john' else 'female'
+            self.assertEqual(person['gender_id'], fk_ids[expected])
+
+    def test_numeric_references(self):
+        # INTEGER and REAL reference tables store '007' as 7 and '1.50' as 1.5
+        with open('tmp/test_fk_numeric.csv', 'w') as csv_file:
+            csv_file.write('007,1.50,x\n7,1.5,y\n07,2,z\n')
+
+        with open('tmp/test_fk_numeric.json', 'w') as mapping_file:
+            json.dump({'table_name': 'item', 'mappings': [
+                {'csv_index': 0, 'column_name': 'code', 'key': 'fk', 'data_type': 'INTEGER'},
+                {'csv_index': 1, 'column_name': 'price', 'key': 'fk', 'data_type': 'REAL'},
+                {'csv_index': 2, 'column_name': 'name'},
+            ]}, mapping_file)
+
+        args = Objectifier(dict(vars(self.args), input='tmp/test_fk_numeric.csv', mapping='tmp/test_fk_numeric.json',
+                                output='tmp/test_fk_numeric.sqlite3', reject_file='tmp/test_fk_numeric.rejects.csv'))
+        importer = libcsv2sqlite.Importer(args)
+
+        try:
+            importer.run()
+            db = importer.connection
+
+            self.assertEqual(importer.rejects.count, 0)
+            self.assertEqual(dbutils.select_id_map('code', db=db), [(7, 1)])
+            self.assertEqual(sorted(value for value, row_id in dbutils.select_id_map('price', db=db)), [1.5, 2.0])
+            self.assertEqual([row['code_id'] for row in dbutils.select_all('item', ['code_id'], db)], [1, 1, 1])
+        finally:
+            importer.close()
+
+            for path in ['tmp/test_fk_numeric.csv', 'tmp/test_fk_numeric.json', args.output]:
+                os.remove(path)
+
+    def test_patch_csv_data(self):
+        rows = [['a', 'x'], ['b', 'y'], ['c', 'x']]
+        fk_patch_data = [{'row_index': 1, 'fk_ids': {'x': 1, 'y': 2}}]
+
+        rows = libcsv2sqlite.patch_csv_data(fk_patch_data, rows)
+
+        self.assertEqual(rows, [('a', 1), ('b', 2), ('c', 1)])
+
+
+class SqlForeignKeyEngineTest(ForeignKeyResolutionTest):
+    @classmethod
+    def setUpClass(cls):
+        cls.args = Objectifier({
+            'input': 'test/test2.csv',
+            'mapping': 'test/test2.json',
+            'output': 'tmp/test2_fk_sql.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+            'batch_size': 2,
+            'fk_engine': 'sql',
+        })
+
+        libcsv2sqlite.csv_to_sqlite3(cls.args)
+
+    def test_append_rejects(self):
+        # Every key exists already, the staged insert fails and the batch is written row by row
+        self.args.reject_file = 'tmp/test2_fk_sql.rejects.csv'
+        dbutils.connection.close()
+        importer = libcsv2sqlite._csv_to_sqlite3(self.args)
+        os.remove(self.args.reject_file)
+
+        self.assertEqual(importer.stats.counters['rejected'], 4)
+        self.assertEqual(dbutils.count('person'), 4)
+        self.assertEqual(dbutils.count('gender'), 2)
+
+    def test_rejects_without_journal(self):
+        # Without a journal the batch goes row by row from the start
+        with open('tmp/test3_sql_unsafe.json', 'w') as mapping_file:
+            json.dump({'table_name': 'taxi', 'mappings': [
+                {'csv_index': 0, 'column_name': 'email', 'key': 'pk'},
+                {'csv_index': 1, 'column_name': 'phone', 'key': 'fk'},
+            ]}, mapping_file)
+
+        args = Objectifier(dict(vars(self.args), input='test/test3.csv', mapping='tmp/test3_sql_unsafe.json',
+                                output='tmp/test3_sql_unsafe.sqlite3', reject_file='tmp/test3_sql_unsafe.rejects.csv',
+                                batch_size=10, profile='unsafe'))
+        importer = libcsv2sqlite.Importer(args)
+
+        try:
+            importer.run()
+
+            self.assertEqual(dbutils.count('taxi', importer.connection), 2)
+            self.assertEqual(importer.rejects.count, 1)
+        finally:
+            importer.close()
+            dbutils.delete_database(args.output)
+
+            for path in [args.mapping, args.reject_file]:
+                os.remove(path)
+
+
+class FkCacheTest(ForeignKeyResolutionTest):
+    @classmethod
+    def setUpClass(cls):
+        cls.args = Objectifier({
+            'input': 'test/test2.csv',
+            'mapping': 'test/test2.json',
+            'output': 'tmp/test2_fk_cache.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+            'batch_size': 2,
+            # Room for a single id of each reference table
+            'fk_max_memory': 0.0003,
+        })
+
+        cls.importer = libcsv2sqlite._csv_to_sqlite3(cls.args)
+
+    def test_counters(self):
+        counters = self.importer.stats.counters
+
+        self.assertEqual(counters['fk_cache_hits'] + counters['fk_cache_misses'], 6)
+        self.assertGreater(counters['fk_cache_evictions'], 0)
+        self.assertEqual(dbutils.count('bombom'), 3)
+
+    def test_lru(self):
+        cache = fkcache.FkCache(2 * (fkcache.ENTRY_OVERHEAD + sys.getsizeof('a')))
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+        self.assertEqual(cache.evictions, 1)
+
+
+class FastCsvTest(unittest.TestCase):
+    def test_same_rows_as_csv_reader(self):
+        for csv_path in ['test/test2.csv', 'test/test12.csv']:
+            with open(csv_path, newline='') as csv_file:
+                expected = list(csv.reader(csv_file))
+
+            self.assertTrue(fastcsv.is_simple_file(csv_path))
+            self.assertEqual(list(fastcsv.iter_rows(csv_path)), expected)
+
+    def test_split_rows(self):
+        text = 'a,b\r\n\r\n,c\r\nd'
+
+        self.assertEqual(fastcsv.split_rows(text), list(csv.reader(io.StringIO(text, newline=''))))
+
+    def test_blocks(self):
+        csv_path = 'tmp/fastcsv.csv'
+
+        with open(csv_path, 'w', newline='') as csv_file:
+            csv_file.write(''.join('{0},value {0}\n'.format(i) for i in range(0, 1000)))
+
+        block_size = fastcsv.BLOCK_SIZE
+        fastcsv.BLOCK_SIZE = 100
+
+        try:
+            rows = list(fastcsv.iter_rows(csv_path))
+        finally:
+            fastcsv.BLOCK_SIZE = block_size
+            os.remove(csv_path)
+
+        self.assertEqual(rows, [[str(i), 'value {}'.format(i)] for i in range(0, 1000)])
+
+    def test_carriage_returns(self):
+        csv_path = 'tmp/fastcsv_crlf.csv'
+
+        for text, simple in [('a,b\r\nc,d\r\n', True), ('a,b\rc,d\r\n', False)]:
+            with open(csv_path, 'w', newline='') as csv_file:
+                csv_file.write(text)
+
+            self.assertEqual(fastcsv.is_simple_file(csv_path), simple)
+
+        os.remove(csv_path)
+
+    def test_quotes_fall_back(self):
+        self.assertFalse(fastcsv.is_simple_file('test/test14.csv'))
+        self.assertFalse(fastcsv.is_simple(b'a\rb'))
+
+
+class CompressedInputTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open('test/test12.csv', 'rb') as csv_file:
+            cls.data = csv_file.read()
+
+        cls.paths = []
+
+    @classmethod
+    def tearDownClass(cls):
+        for path in cls.paths:
+            os.remove(path)
+
+    def import_file(self, path):
+        self.paths.append(path)
+
+        args = Objectifier({
+            'input': path,
+            'mapping': '',
+            'output': 'tmp/test12_compressed.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': True,
+        })
+
+        libcsv2sqlite.csv_to_sqlite3(args)
+        rows = dbutils.count('test12')
+
+        dbutils.connection.close()
+        dbutils.delete_database(args.output)
+
+        return rows
+
+    def test_stream_formats(self):
+        for extension, open_function in [('gz', gzip.open), ('bz2', bz2.open), ('xz', lzma.open)]:
+            path = 'tmp/test12.csv.' + extension
+
+            with open_function(path, 'wb') as compressed_file:
+                compressed_file.write(self.data)
+
+            self.assertEqual(self.import_file(path), 2)
+
+    def test_magic_bytes(self):
+        path = 'tmp/test12.csv.data'
+
+        with open(path, 'wb') as raw_file:
+            raw_file.write(gzip.compress(self.data))
+
+        self.assertEqual(libcsv2sqlite.detect_compression(path), 'gzip')
+        self.paths.append(path)
+
+    def test_zip_members(self):
+        path = 'tmp/test12.zip'
+
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr('part1.csv', self.data)
+            archive.writestr('part2.csv', self.data.replace(b'bill', b'will'))
+
+        self.assertEqual(self.import_file(path), 4)
+
+
+class ParallelImportTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.args = Objectifier({
+            'input': 'test/test14.csv',
+            'mapping': 'test/test14.json',
+            'output': 'tmp/test14.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': True,
+            'workers': 2,
+        })
+
+        cls.range_size = parallel.RANGE_SIZE
+        parallel.RANGE_SIZE = 16
+
+    @classmethod
+    def tearDownClass(cls):
+        parallel.RANGE_SIZE = cls.range_size
+        dbutils.connection.close()
+        dbutils.delete_database(cls.args.output)
+
+    def test_row_ranges(self):
+        with open(self.args.input, newline='') as csv_file:
+            expected = list(csv.reader(csv_file))
+
+        rows = []
+        with open(self.args.input, 'rb') as csv_file:
+            for start, end in parallel.iter_row_ranges(self.args.input, 0, 16):
+                csv_file.seek(start)
+                text = csv_file.read(end - start).decode()
+                rows.extend(csv.reader(text.splitlines(True)))
+
+        self.assertEqual(rows, expected)
+
+    def test_csv_to_sqlite3(self):
+        libcsv2sqlite.csv_to_sqlite3(self.args)
+
+        people = dbutils.select_all('person', ['name', 'notes'])
+
+        self.assertEqual(len(people), 5)
+        self.assertEqual(people[2]['name'], 'carla, jr')
+        self.assertEqual(people[2]['notes'], 'MULTI\nLINE\nNOTE')
+
+
+
+class ShardedImportTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.range_size = parallel.RANGE_SIZE
+        parallel.RANGE_SIZE = 16
+
+    @classmethod
+    def tearDownClass(cls):
+        parallel.RANGE_SIZE = cls.range_size
+
+    def import_file(self, csv_path, mapping, shards, output, profile='safe', batch_size=10000):
+        args = Objectifier({
+            'input': csv_path,
+            'mapping': mapping,
+            'output': output,
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+            'shards': shards,
+            'profile': profile,
+            'batch_size': batch_size,
+        })
+
+        importer = libcsv2sqlite.Importer(args)
+        importer.run()
+
+        self.addCleanup(dbutils.delete_database, output)
+        self.addCleanup(importer.close)
+
+        return importer
+
+    def resolved_rows(self, importer):
+        db = importer.connection
+        genders = dict((row_id, value) for value, row_id in dbutils.select_id_map('gender', db=db))
+        bombons = dict((row_id, value) for value, row_id in dbutils.select_id_map('bombom', db=db))
+
+        return [(row['name'], genders[row['gender_id']], bombons[row['bombom_id']])
+                for row in dbutils.select_all('person', ['name', 'gender_id', 'bombom_id'], db)]
+
+    def test_same_rows(self):
+        sharded = self.import_file('test/test2.csv', 'test/test2.json', 2, 'tmp/test2_sharded.sqlite3')
+        serial = self.import_file('test/test2.csv', 'test/test2.json', 0, 'tmp/test2_serial.sqlite3')
+
+        self.assertEqual(self.resolved_rows(sharded), self.resolved_rows(serial))
+        self.assertEqual(sharded.stats.counters['rows'], 4)
+        self.assertIn('merge', sharded.stats.stages)
+        self.assertFalse([path for path in os.listdir('tmp') if path.endswith('.csv2sqlite-shards')])
+
+    def test_replace(self):
+        importer = self.import_file('test/test3.csv', 'test/test3.json', 2, 'tmp/test3_sharded.sqlite3')
+
+        phones = dict((row['email'], row['phone'])
+                      for row in dbutils.select_all('taxi', ['email', 'phone'], importer.connection))
+
+        self.assertEqual(phones['bob@xxx.com'], '3123-1231')
+        self.assertEqual(importer.stats.counters['inserted'], 2)
+        self.assertEqual(importer.stats.counters['updated'], 1)
+
+    def test_rejects(self):
+        importer = self.import_file('test/test3.csv', 'test/test17.json', 2, 'tmp/test17_sharded.sqlite3')
+        self.addCleanup(os.remove, importer.rejects.path)
+
+        self.assertEqual(dbutils.count('taxi', importer.connection), 2)
+
+        with open(importer.rejects.path) as reject_file:
+            rows = list(csv.reader(reject_file))
+
+        self.assertEqual(rows[1][:2], ['test/test3.csv', '3'])
+        self.assertEqual(rows[1][3:], ['bob@xxx.com', '3123-1231'])
+
+    def test_rejects_without_journal(self):
+        # The failed merge can't be rolled back, only the refused row is rejected
+        importer = self.import_file('test/test3.csv', 'test/test17.json', 2, 'tmp/test17_sharded_unsafe.sqlite3', 'unsafe')
+        self.addCleanup(os.remove, importer.rejects.path)
+
+        self.assertEqual(dbutils.count('taxi', importer.connection), 2)
+        self.assertEqual(importer.rejects.count, 1)
+
+    def test_merge_sources(self):
+        # The second bob is in the first shard, its source record comes from there
+        db = dbutils.connect('tmp/test_merge.sqlite3', 'unsafe')
+        db.execute('CREATE TABLE taxi (email TEXT PRIMARY KEY, phone TEXT)')
+        self.addCleanup(dbutils.delete_database, 'tmp/test_merge.sqlite3')
+        self.addCleanup(db.close)
+
+        for n, rows in enumerate([[(2, 'bob', '2')], [(1, 'bob', '1'), (3, 'ann', '3')]]):
+            shard = sqlite3.connect('tmp/test_merge_{}.sqlite3'.format(n))
+            shard.execute('CREATE TABLE taxi (email TEXT, phone TEXT)')
+            shard.executemany('INSERT INTO taxi (rowid, email, phone) VALUES (?, ?, ?)', rows)
+            shard.commit()
+            shard.close()
+
+            dbutils.attach('tmp/test_merge_{}.sqlite3'.format(n), 'shard{}'.format(n), db)
+            self.addCleanup(dbutils.delete_database, 'tmp/test_merge_{}.sqlite3'.format(n))
+            self.addCleanup(dbutils.detach, 'shard{}'.format(n), db)
+
+        rejected = dbutils.merge_shards('taxi', ['email', 'phone'], {}, ['shard0', 'shard1'], db=db)
+
+        self.assertEqual([(rowid, record) for rowid, error, record in rejected], [(2, ('bob', '2'))])
+        self.assertEqual(dbutils.count('taxi', db), 2)
+
+    def test_merge_batches(self):
+        # Without a journal the merge is written batch_size rows at a time, in CSV order
+        batches = []
+        insert_many = dbutils.insert_many
+
+        def recorded_insert_many(table_name, keys, records, *args, **kwargs):
+            batches.append(len(records))
+            return insert_many(table_name, keys, records, *args, **kwargs)
+
+        dbutils.insert_many = recorded_insert_many
+
+        try:
+            sharded = self.import_file('test/test2.csv', 'test/test2.json', 2, 'tmp/test2_sharded_unsafe.sqlite3',
+                                       'unsafe', 3)
+        finally:
+            dbutils.insert_many = insert_many
+
+        serial = self.import_file('test/test2.csv', 'test/test2.json', 0, 'tmp/test2_serial.sqlite3')
+
+        self.assertEqual(batches, [3, 1])
+        self.assertEqual(self.resolved_rows(sharded), self.resolved_rows(serial))
+
+class ImportStatsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.args = Objectifier({
+            'input': 'test/test2.csv',
+            'mapping': 'test/test2.json',
+            'output': 'tmp/test2_stats.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+            'batch_size': 2,
+            'stats_json': 'tmp/test2_stats.json',
+        })
+
+        cls.reports = []
+        stats.register_hook(cls.reports.append)
+
+        libcsv2sqlite.csv_to_sqlite3(cls.args)
+
+        stats.unregister_hook(cls.reports.append)
+
+    @classmethod
+    def tearDownClass(cls):
+        dbutils.connection.close()
+        dbutils.delete_database(cls.args.output)
+        os.remove(cls.args.stats_json)
+
+    def test_hook(self):
+        self.assertEqual(len(self.reports), 1)
+
+        report = self.reports[0]
+
+        self.assertEqual(report['counters']['rows'], 4)
+        self.assertEqual(report['stages']['insert']['rows'], 4)
+        self.assertEqual(report['stages']['parse']['rows'], 4)
+        self.assertEqual(report['stages']['parse']['bytes'], os.path.getsize(self.args.input))
+        self.assertIsNotNone(report['stages']['parse']['bytes_per_second'])
+        self.assertEqual(report['counters']['bytes'], os.path.getsize(self.args.input))
+        self.assertGreater(report['counters']['commits'], 1)
+        self.assertGreater(report['counters']['statements'], 2)
+
+    def test_json(self):
+        with open(self.args.stats_json) as json_file:
+            report = json.load(json_file)
+
+        self.assertIn('fk_normalization', report['stages'])
+
+    def test_nested_stages(self):
+        import_stats = stats.ImportStats()
+
+        import_stats.start('outer')
+        import_stats.start('inner')
+        import_stats.stop(3)
+        import_stats.stop()
+        import_stats.finish()
+
+        self.assertEqual(import_stats.stages['inner']['rows'], 3)
+        self.assertIn('peak_memory_kb', import_stats.counters)
+
+
+class ReadAheadTest(unittest.TestCase):
+    def test_import(self):
+        args = Objectifier({
+            'input': 'test/test2.csv',
+            'mapping': 'test/test2.json',
+            'output': 'tmp/test2_queue.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+            'batch_size': 1,
+            'queue_size': 1,
+        })
+
+        importer = libcsv2sqlite.Importer(args)
+        importer.run()
+
+        self.assertEqual(dbutils.count('person', importer.connection), 4)
+        self.assertEqual(importer.stats.stages['parse']['rows'], 4)
+        self.assertEqual(importer.stats.stages['writer_idle']['rows'], 4)
+        self.assertIn('reader_idle', importer.stats.stages)
+
+        importer.close()
+        dbutils.delete_database(args.output)
+
+    def test_order(self):
+        self.assertEqual(list(parallel.read_ahead(iter(range(0, 100)), 2)), list(range(0, 100)))
+
+    def test_reader_error(self):
+        def items():
+            yield 1
+            raise ValueError('broken row')
+
+        with self.assertRaises(ValueError):
+            list(parallel.read_ahead(items(), 1))
+
+    def test_writer_error(self):
+        produced = []
+
+        def items():
+            for i in itertools.count():
+                produced.append(i)
+                yield i
+
+        reader = parallel.read_ahead(items(), 2)
+        next(reader)
+        reader.close()
+
+        # The reader thread stopped with a full queue
+        self.assertLessEqual(len(produced), 5)
+
+
+class ProgressTest(unittest.TestCase):
+    def test_rate_limit(self):
+        size = os.path.getsize('test/test2.csv')
+        position = {'path': 'test/test2.csv', 'tell': lambda: size // 2}
+        stream = io.StringIO()
+        reporter = progress.ProgressReporter(['test/test2.csv'], position, stream, 60)
+
+        reporter.update('parse', 2)
+        self.assertEqual(stream.getvalue(), '')
+
+        reporter.update('parse', 2, True)
+        self.assertIn('{:.1f}%'.format(size // 2 / size * 100), stream.getvalue())
+        self.assertIn('parse', stream.getvalue())
+
+        reporter.finish(4)
+        self.assertEqual(len(stream.getvalue().splitlines()), 2)
+
+    def test_compressed_import(self):
+        csv_path = 'tmp/test2_progress.csv.gz'
+
+        with open('test/test2.csv', 'rb') as csv_file, gzip.open(csv_path, 'wb') as gzip_file:
+            gzip_file.write(csv_file.read())
+
+        args = Objectifier({
+            'input': csv_path,
+            'mapping': 'test/test2.json',
+            'output': 'tmp/test2_progress.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+            'batch_size': 1,
+            'progress': True,
+        })
+
+        stderr, sys.stderr = sys.stderr, io.StringIO()
+        log_interval, progress.LOG_INTERVAL = progress.LOG_INTERVAL, 1e-9
+
+        try:
+            importer = libcsv2sqlite.Importer(args)
+            importer.run()
+            lines = sys.stderr.getvalue().splitlines()
+        finally:
+            sys.stderr = stderr
+            progress.LOG_INTERVAL = log_interval
+
+        importer.close()
+        dbutils.delete_database(args.output)
+        os.remove(csv_path)
+
+        self.assertGreater(len(lines), 4)
+        self.assertTrue(lines[-1].startswith('100.0%'))
+        self.assertIn('4 rows', lines[-1])
+        self.assertIn('done', lines[-1])
+
+class MultipleInputsTest(unittest.TestCase):
+    def import_inputs(self, inputs, table_name, workers=1):
+        args = Objectifier({
+            'input': inputs,
+            'mapping': '',
+            'output': 'tmp/test_multiple.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': True,
+            'workers': workers,
+        })
+
+        libcsv2sqlite.csv_to_sqlite3(args)
+        names = [row['name'] for row in dbutils.select_all(table_name, ['name'])]
+
+        dbutils.connection.close()
+        dbutils.delete_database(args.output)
+
+        return names
+
+    def test_expand_inputs(self):
+        paths = libcsv2sqlite.expand_inputs(['test/test1[32].csv', 'test/test1.csv'])
+
+        self.assertEqual(paths, ['test/test12.csv', 'test/test13.csv', 'test/test1.csv'])
+
+    def test_glob(self):
+        names = self.import_inputs(['test/test1[23].csv'], 'test12')
+
+        self.assertEqual(names, ['bill', 'christian', 'bill', 'christian'])
+
+    def test_directory(self):
+        os.makedirs('tmp/multiple', exist_ok=True)
+
+        with open('test/test12.csv', 'rb') as csv_file:
+            data = csv_file.read()
+
+        with open('tmp/multiple/part1.csv', 'wb') as csv_file:
+            csv_file.write(data)
+
+        with gzip.open('tmp/multiple/part2.csv.gz', 'wb') as csv_file:
+            csv_file.write(data.replace(b'bill', b'will'))
+
+        names = self.import_inputs('tmp/multiple', 'part1', workers=2)
+
+        os.remove('tmp/multiple/part1.csv')
+        os.remove('tmp/multiple/part2.csv.gz')
+        os.rmdir('tmp/multiple')
+
+        self.assertEqual(names, ['bill', 'christian', 'will', 'christian'])
+
+
+class IncrementalImportTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.args = Objectifier({
+            'input': 'tmp/test_incremental.csv',
+            'mapping': '',
+            'output': 'tmp/test_incremental.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': True,
+            'incremental': True,
+            'batch_size': 2,
+        })
+
+    @classmethod
+    def tearDownClass(cls):
+        dbutils.delete_database(cls.args.output)
+        os.remove(cls.args.input)
+
+    def write(self, text, mode='a'):
+        with open(self.args.input, mode) as csv_file:
+            csv_file.write(text)
+
+    def import_count(self):
+        libcsv2sqlite.csv_to_sqlite3(self.args)
+        rows = dbutils.count('test_incremental')
+        checkpoint = dbutils.get_checkpoint(os.path.abspath(self.args.input), 'test_incremental')
+        dbutils.connection.close()
+
+        return rows, checkpoint
+
+    def test_bytes(self):
+        # Only what this run read counts, not what earlier runs imported
+        self.addCleanup(dbutils.delete_database, self.args.output)
+        self.write('name,age\nbill,56\n', 'w')
+
+        importer = libcsv2sqlite._csv_to_sqlite3(self.args)
+        importer.close()
+
+        self.assertEqual(importer.stats.counters['bytes'], len('bill,56\n'))
+
+        self.write('christian,23\n')
+
+        importer = libcsv2sqlite._csv_to_sqlite3(self.args)
+        importer.close()
+
+        self.assertEqual(importer.stats.counters['bytes'], len('christian,23\n'))
+        self.assertEqual(importer.stats.stages['parse']['bytes'], len('christian,23\n'))
+
+    def test_incremental(self):
+        self.write('name,age\nbill,56\nchristian,23\nmary,"3\n4"\n', 'w')
+
+        rows, checkpoint = self.import_count()
+        self.assertEqual(rows, 3)
+        self.assertEqual(checkpoint['row_count'], 3)
+        self.assertEqual(checkpoint['byte_offset'], os.path.getsize(self.args.input))
+
+        # The unfinished last line waits for the next run
+        self.write('john,34\njane,4')
+
+        rows, checkpoint = self.import_count()
+        self.assertEqual(rows, 4)
+
+        self.write('5\n')
+
+        rows, checkpoint = self.import_count()
+        self.assertEqual(rows, 5)
+        self.assertEqual(checkpoint['row_count'], 5)
+
+        rows, _ = self.import_count()
+        self.assertEqual(rows, 5)
+
+        # A replaced file is imported from the start
+        self.write('name,age\nrose,77\n', 'w')
+
+        rows, checkpoint = self.import_count()
+        self.assertEqual(rows, 6)
+        self.assertEqual(checkpoint['row_count'], 1)
+
+
 class MappingTestPrimaryKey(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -85,6 +861,232 @@ class MappingTestPrimaryKey(unittest.TestCase):
         self.assertEqual(dbutils.count('taxi'), 2)
 
 
+class IndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.args = Objectifier({
+            'input': 'test/test2.csv',
+            'mapping': 'test/test15.json',
+            'output': 'tmp/test15.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+        })
+
+        libcsv2sqlite.csv_to_sqlite3(cls.args)
+
+    @classmethod
+    def tearDownClass(cls):
+        dbutils.connection.close()
+        dbutils.delete_database(cls.args.output)
+
+    def test_indexes(self):
+        indexes = dbutils.list_indexes('person')
+
+        self.assertIn('ix_person_name', indexes)
+        self.assertIn('ix_person_gender_id', indexes)
+        self.assertIn('ix_person_gender_id_age', indexes)
+        self.assertIn('ux_person_name2', indexes)
+        self.assertTrue(dbutils.column_is_pk('person', 'email'))
+
+
+class OnConflictTest(unittest.TestCase):
+    def setUp(self):
+        self.reports = []
+        stats.register_hook(self.reports.append)
+
+    def tearDown(self):
+        stats.unregister_hook(self.reports.append)
+        dbutils.connection.close()
+        dbutils.delete_database('tmp/test16.sqlite3')
+
+    def import_file(self, csv_path, on_conflict):
+        libcsv2sqlite.csv_to_sqlite3(Objectifier({
+            'input': csv_path,
+            'mapping': 'test/test3.json',
+            'output': 'tmp/test16.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+            'on_conflict': on_conflict,
+        }))
+
+        return self.reports[-1]['counters']
+
+    def phones(self):
+        return dict((row['email'], row['phone']) for row in dbutils.select_all('taxi', ['email', 'phone']))
+
+    def test_ignore(self):
+        counters = self.import_file('test/test3.csv', 'ignore')
+
+        self.assertEqual(self.phones()['bob@xxx.com'], '9999-9999')
+        self.assertEqual((counters['inserted'], counters['updated'], counters['skipped']), (2, 0, 1))
+
+    def test_update_snapshot(self):
+        self.import_file('test/test3.csv', 'update')
+        counters = self.import_file('test/test16.csv', 'update')
+
+        phones = self.phones()
+
+        self.assertEqual(len(phones), 3)
+        self.assertEqual(phones['bob@xxx.com'], '1111-1111')
+        self.assertEqual((counters['inserted'], counters['updated'], counters['skipped']), (1, 1, 0))
+
+    def test_insert_mode(self):
+        # Without --on-conflict the "insert_mode" of the mapping applies
+        counters = self.import_file('test/test3.csv', None)
+
+        self.assertEqual(self.phones()['bob@xxx.com'], '3123-1231')
+        self.assertEqual(counters['updated'], 1)
+
+
+class RejectFileTest(unittest.TestCase):
+    def setUp(self):
+        self.args = Objectifier({
+            'input': 'test/test3.csv',
+            'mapping': 'test/test17.json',
+            'output': 'tmp/test17.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+        })
+
+    def tearDown(self):
+        dbutils.connection.close()
+
+        if os.path.exists(self.args.output):
+            dbutils.delete_database(self.args.output)
+
+        if os.path.exists('tmp/test17.rejects.csv'):
+            os.remove('tmp/test17.rejects.csv')
+
+    def test_rejects(self):
+        libcsv2sqlite.csv_to_sqlite3(self.args)
+
+        self.assertEqual(dbutils.count('taxi'), 2)
+
+        with open('tmp/test17.rejects.csv') as reject_file:
+            rows = list(csv.reader(reject_file))
+
+        self.assertEqual(rows[0], ['file', 'line', 'error', 'email', 'phone'])
+        self.assertEqual(rows[1][:2], ['test/test3.csv', '3'])
+        self.assertIn('UNIQUE', rows[1][2])
+        self.assertEqual(rows[1][3:], ['bob@xxx.com', '3123-1231'])
+
+    def test_unique_index(self):
+        # Upper case names must be unique, the second mary is rejected instead of deleted
+        with open('tmp/test_unique.csv', 'w') as csv_file:
+            csv_file.write('mary,23,female,mary@mary.com\nMary,30,female,mary@gmail.com\njohn,34,male,john@gmail.com\n')
+
+        self.args.input = 'tmp/test_unique.csv'
+        self.args.mapping = 'test/test15.json'
+        self.args.defer_indexes = True
+        self.args.reject_file = 'tmp/test17.rejects.csv'
+
+        importer = libcsv2sqlite._csv_to_sqlite3(self.args)
+        os.remove('tmp/test_unique.csv')
+
+        with open('tmp/test17.rejects.csv') as reject_file:
+            rows = list(csv.reader(reject_file))
+
+        self.assertEqual(dbutils.count('person'), 2)
+        self.assertEqual(importer.rejects.count, 1)
+        self.assertEqual(rows[1][:2], ['tmp/test_unique.csv', '2'])
+        self.assertIn('UNIQUE', rows[1][2])
+
+    def test_file_lines(self):
+        # Lines count from the start of every file, a quoted record takes two
+        with open('tmp/test_lines1.csv', 'w') as csv_file:
+            csv_file.write('email,phone\n"bob\nsmith",1\nann,2\nann,5\n')
+
+        with open('tmp/test_lines2.csv', 'w') as csv_file:
+            csv_file.write('email,phone\ncarl,3\nann,4\n')
+
+        self.addCleanup(os.remove, 'tmp/test_lines1.csv')
+        self.addCleanup(os.remove, 'tmp/test_lines2.csv')
+
+        self.args.input = ['tmp/test_lines1.csv', 'tmp/test_lines2.csv']
+        self.args.csv_has_title_columns = True
+        self.args.reject_file = 'tmp/test17.rejects.csv'
+
+        for options in [{'shards': 2}, {'workers': 2}, {}]:
+            with self.subTest(**options):
+                libcsv2sqlite._csv_to_sqlite3(Objectifier(dict(vars(self.args), **options)))
+                dbutils.connection.close()
+                dbutils.delete_database(self.args.output)
+
+                with open(self.args.reject_file) as reject_file:
+                    rows = sorted(row[:2] for row in csv.reader(reject_file))
+
+                self.assertEqual(rows, [['file', 'line'], ['tmp/test_lines1.csv', '5'], ['tmp/test_lines2.csv', '3']])
+
+    def test_max_errors(self):
+        self.args.max_errors = 0
+
+        with self.assertRaises(exceptions.TooManyErrors):
+            libcsv2sqlite._csv_to_sqlite3(self.args)
+
+    def test_insert_many(self):
+        dbutils.create_and_connect(self.args.output)
+        dbutils.create_table('numbers', [{'column_name': 'value', 'data_type': 'INTEGER', 'key': 'pk'}])
+
+        rejected = dbutils.insert_many('numbers', ['value'], [(1,), (2,), (1,), (2 ** 70,), (3,)])
+
+        self.assertEqual([position for position, _ in rejected], [2, 3])
+        self.assertEqual(dbutils.count('numbers'), 3)
+
+
+class DeferredIndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.args = Objectifier({
+            'input': 'test/test3.csv',
+            'mapping': 'test/test3.json',
+            'output': 'tmp/test3_deferred.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+            'defer_indexes': True,
+        })
+
+        cls.importer = libcsv2sqlite._csv_to_sqlite3(cls.args)
+
+    @classmethod
+    def tearDownClass(cls):
+        dbutils.connection.close()
+        dbutils.delete_database(cls.args.output)
+
+    def test_counters(self):
+        # Duplicates are only counted once the key is built
+        counters = self.importer.stats.counters
+
+        self.assertEqual((counters['inserted'], counters['updated'], counters['skipped']), (2, 1, 0))
+
+    def test_update(self):
+        # Plain inserts while the key is missing, the last row wins like with replace
+        args = Objectifier(dict(vars(self.args), output='tmp/test3_deferred_update.sqlite3', on_conflict='update'))
+        importer = libcsv2sqlite.Importer(args)
+
+        try:
+            counters = importer.run().counters
+            phones = dict((row['email'], row['phone']) for row in
+                          dbutils.select_all('taxi', ['email', 'phone'], importer.connection))
+        finally:
+            importer.close()
+            dbutils.delete_database(args.output)
+
+        self.assertEqual((counters['inserted'], counters['updated'], counters['skipped']), (2, 1, 0))
+        self.assertEqual(phones['bob@xxx.com'], '3123-1231')
+
+    def test_deferred_pk(self):
+        self.assertFalse(dbutils.column_is_pk('taxi', 'email'))
+        self.assertIn('ux_taxi_email', dbutils.list_indexes('taxi'))
+
+        phones = dbutils.select_all('taxi', ['email', 'phone'])
+
+        self.assertEqual(len(phones), 2)
+
+        # The mapping asks to replace, the last row of a duplicated key wins
+        bob = [row for row in phones if row['email'] == 'bob@xxx.com']
+        self.assertEqual(bob[0]['phone'], '3123-1231')
+
+
 class MappingTestFirstLine(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -122,7 +1124,7 @@ class CustomTransformationsTest(unittest.TestCase):
             'csv_has_title_columns': True,
         })
 
-        libcsv2sqlite.csv_to_sqlite3(cls.args)
+        cls.importer = libcsv2sqlite._csv_to_sqlite3(cls.args)
 
     @classmethod
     def tearDownClass(cls):
@@ -130,7 +1132,211 @@ class CustomTransformationsTest(unittest.TestCase):
         dbutils.delete_database(cls.args.output)
 
     def test_explode_existence(self):
-        self.assertTrue(hasattr(transformations, 'explode'))
+        # Custom transformations belong to the import, not to the transformations module
+        self.assertIn('explode', self.importer.registry)
+        self.assertFalse(hasattr(transformations, 'explode'))
+
+
+class ServiceTest(unittest.TestCase):
+    output = 'tmp/test_service.sqlite3'
+    csv_paths = ['tmp/service_a.csv', 'tmp/service_b.csv']
+    spool_dir = 'tmp/spool'
+
+    def setUp(self):
+        for i, csv_path in enumerate(self.csv_paths):
+            with open(csv_path, 'w') as csv_file:
+                for name, gender in [('mary', 'female'), ('john', 'male')]:
+                    csv_file.write('{0},30,{1},{0}{2}@mail.com,cacau show\n'.format(name, gender, i))
+
+    def tearDown(self):
+        for path in self.csv_paths + [self.output]:
+            if os.path.exists(path):
+                os.remove(path)
+
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def args(self):
+        return Objectifier({
+            'input': None,
+            'mapping': 'test/test2.json',
+            'output': self.output,
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+        })
+
+    def test_importer_state(self):
+        state = {}
+
+        for csv_path in self.csv_paths:
+            importer = libcsv2sqlite.Importer(service.job_args(self.args(), {'input': csv_path}), state)
+            import_stats = importer.run()
+            importer.close()
+
+        # The second import reused the plan, the connection and the reference ids
+        self.assertEqual(import_stats.counters['mapping_cache_hits'], 1)
+        self.assertEqual(sorted(state['fk_ids']['gender']), ['female', 'male'])
+        self.assertEqual(dbutils.count('person', state['connection']), 4)
+        self.assertEqual(dbutils.count('gender', state['connection']), 2)
+
+        state['connection'].close()
+
+    def test_jobs(self):
+        import_service = service.Service(self.args(), 2)
+        import_service.start()
+        results = []
+
+        for csv_path in self.csv_paths + ['tmp/service_missing.csv']:
+            import_service.submit({'input': [csv_path]}, results.append)
+
+        import_service.stop()
+        status = import_service.status()
+
+        self.assertEqual([result['status'] for result in results], ['ok', 'ok', 'error'])
+        self.assertEqual((status['jobs'], status['failed'], status['rows'], status['queued']), (3, 1, 4, 0))
+        self.assertIsNotNone(status['latency_p95'])
+
+    def test_spool_dir(self):
+        os.makedirs(self.spool_dir)
+        shutil.copy(self.csv_paths[0], os.path.join(self.spool_dir, 'a.csv'))
+        shutil.copy(self.csv_paths[1], os.path.join(self.spool_dir, '.b.csv'))
+
+        import_service = service.Service(self.args())
+        import_service.start()
+        pending = set()
+        service.scan_spool(import_service, self.spool_dir, pending)
+        import_service.stop()
+
+        # Files still being written are left alone
+        self.assertTrue(os.path.exists(os.path.join(self.spool_dir, service.DONE_DIR, 'a.csv')))
+        self.assertTrue(os.path.exists(os.path.join(self.spool_dir, '.b.csv')))
+        self.assertEqual(pending, set())
+
+    def test_socket(self):
+        import_service = service.Service(self.args())
+        import_service.start()
+        server = service.JobServer('tmp/service.sock', import_service)
+        threading.Thread(target=server.serve_forever).start()
+
+        client = socket.socket(socket.AF_UNIX)
+        client.connect('tmp/service.sock')
+        lines = client.makefile('rw')
+
+        def request(data):
+            lines.write(json.dumps(data) + '\n')
+            lines.flush()
+            return json.loads(lines.readline())
+
+        try:
+            self.assertEqual(request({'input': self.csv_paths})['rows'], 4)
+            self.assertEqual(request({'command': 'status'})['jobs'], 1)
+            self.assertEqual(request({'output': self.output})['status'], 'error')
+        finally:
+            lines.close()
+            client.close()
+            server.shutdown()
+            server.server_close()
+            os.remove('tmp/service.sock')
+            import_service.stop()
+
+
+class ImporterThreadsTest(unittest.TestCase):
+    def setUp(self):
+        self.args = [Objectifier({
+            'input': 'test/test2.csv',
+            'mapping': 'test/test2.json',
+            'output': 'tmp/test2_thread{}.sqlite3'.format(i),
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+            'batch_size': 1,
+        }) for i in range(0, 4)]
+
+        # Rows left by an aborted run would all be rejected as duplicates
+        self.tearDown()
+
+    def tearDown(self):
+        for args in self.args:
+            for path in [args.output, libcsv2sqlite.reject_path(args)]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def test_concurrent_imports(self):
+        importers = [libcsv2sqlite.Importer(args) for args in self.args]
+        counts = {}
+        rejects = {}
+
+        def run(importer):
+            # Connections can only be used by the thread that opened them
+            importer.run()
+            counts[importer.args.output] = dbutils.count(importer.table_name, importer.connection)
+            rejects[importer.args.output] = importer.rejects.count
+            importer.close()
+
+        threads = [threading.Thread(target=run, args=(importer,)) for importer in importers]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        for importer in importers:
+            self.assertEqual(counts[importer.args.output], 4)
+            self.assertEqual(rejects[importer.args.output], 0)
+
+
+class InMemoryBuildTest(unittest.TestCase):
+    def setUp(self):
+        self.args = Objectifier({
+            'input': 'test/test2.csv',
+            'mapping': 'test/test2.json',
+            'output': 'tmp/test2_memory.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+            'build_in_memory': 'always',
+        })
+
+    def tearDown(self):
+        dbutils.connection.close()
+        dbutils.delete_database(self.args.output)
+
+    def test_new_database(self):
+        libcsv2sqlite.csv_to_sqlite3(self.args)
+
+        self.assertEqual(dbutils.count('person'), 4)
+        self.assertFalse(os.path.exists(self.args.output + '.csv2sqlite-tmp'))
+
+    def test_append(self):
+        self.args.build_in_memory = 'never'
+        libcsv2sqlite.csv_to_sqlite3(self.args)
+        dbutils.connection.close()
+
+        # The existing tables are copied into memory and written back with the new one
+        self.args.input = 'test/test3.csv'
+        self.args.mapping = 'test/test3.json'
+        self.args.build_in_memory = 'always'
+        libcsv2sqlite.csv_to_sqlite3(self.args)
+
+        self.assertEqual(dbutils.count('person'), 4)
+        self.assertEqual(dbutils.count('taxi'), 2)
+
+    def test_wal_database(self):
+        db = sqlite3.connect(self.args.output)
+        db.execute('PRAGMA journal_mode = WAL').fetchall()
+        db.close()
+
+        libcsv2sqlite.csv_to_sqlite3(self.args)
+
+        self.assertEqual(dbutils.get_pragma('journal_mode'), 'wal')
+        self.assertEqual(dbutils.count('person'), 4)
+
+    def test_auto(self):
+        self.args.build_in_memory = 'auto'
+        size = libcsv2sqlite.estimated_build_size(['test/test2.csv'], self.args.output)
+
+        self.assertEqual(size, os.path.getsize('test/test2.csv') * libcsv2sqlite.DATABASE_SIZE_FACTOR)
+        self.assertTrue(libcsv2sqlite.build_in_memory(self.args, ['test/test2.csv']))
+
+        libcsv2sqlite.csv_to_sqlite3(self.args)
 
 
 class WeirdHeadersTest(unittest.TestCase):
@@ -344,6 +1550,87 @@ class DbUtilsTest(unittest.TestCase):
         self.assertEqual(all_results[0]['yeah'], 'bla')
 
 
+class LoadProfileTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.db_path = 'tmp/profiletest.sqlite3'
+        dbutils.create_and_connect(cls.db_path, 'fast')
+
+    @classmethod
+    def tearDownClass(cls):
+        dbutils.connection.close()
+        dbutils.delete_database(cls.db_path)
+
+    def test_profile(self):
+        self.assertEqual(dbutils.get_pragma('page_size'), 65536)
+        self.assertEqual(dbutils.get_pragma('journal_mode'), 'wal')
+        self.assertEqual(dbutils.get_pragma('synchronous'), 1)
+
+        dbutils.create_table('bla')
+        dbutils.finish_load()
+
+        self.assertEqual(dbutils.get_pragma('journal_mode'), 'delete')
+        self.assertEqual(dbutils.get_pragma('synchronous'), 2)
+
+    def test_wal_database(self):
+        # A WAL database stays one, whatever the profile used to load it
+        db_path = 'tmp/profiletest_wal.sqlite3'
+
+        for profile in dbutils.PROFILES:
+            db = sqlite3.connect(db_path)
+            db.execute('PRAGMA journal_mode = WAL').fetchall()
+            db.close()
+
+            db = dbutils.connect(db_path, profile)
+            dbutils.create_table('bla', db=db)
+            dbutils.finish_load(db)
+
+            self.assertEqual(dbutils.get_pragma('journal_mode', db), 'wal')
+            self.assertEqual(dbutils.get_pragma('locking_mode', db), 'normal')
+
+            other = sqlite3.connect(db_path, timeout=0.1)
+            other.execute('INSERT INTO bla DEFAULT VALUES')
+            other.commit()
+            other.close()
+
+            db.close()
+            dbutils.delete_database(db_path)
+
+    def test_failed_import(self):
+        # The duplicate key stops the import, the database still gets its journal back
+        args = Objectifier({
+            'input': 'test/test3.csv',
+            'mapping': 'test/test17.json',
+            'output': 'tmp/profiletest_failed.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': False,
+            'reject_file': 'tmp/profiletest_failed.rejects.csv',
+            'max_errors': 0,
+            'profile': 'fast',
+        })
+
+        db = sqlite3.connect(args.output)
+        db.execute('CREATE TABLE bla (id INTEGER)')
+        db.close()
+
+        importer = libcsv2sqlite.Importer(args)
+
+        try:
+            with self.assertRaises(exceptions.TooManyErrors):
+                importer.run()
+
+            self.assertEqual(dbutils.get_pragma('journal_mode', importer.connection), 'delete')
+
+            other = sqlite3.connect(args.output, timeout=0.1)
+            other.execute('INSERT INTO bla DEFAULT VALUES')
+            other.commit()
+            other.close()
+        finally:
+            importer.close()
+            dbutils.delete_database(args.output)
+            os.remove(args.reject_file)
+
+
 class TransformationsTest(unittest.TestCase):
     def test_transformations(self):
         self.assertEqual(transformations.sqlite_upper('aaa'), 'AAA')
@@ -411,6 +1698,224 @@ class DataTypeGuesserTest(unittest.TestCase):
             ['2', '3', '5', '-1', '0.4qwdqwdqwd', '1231231231', '-23123121'])), str)
 
 
+class CompiledTransformTest(unittest.TestCase):
+    def test_projection(self):
+        mappings = [
+            {'csv_index': 2, 'transform': None},
+            {'csv_index': 0, 'transform': None}
+        ]
+
+        chunk_transform = libcsv2sqlite.compile_transform(mappings)
+
+        self.assertEqual(chunk_transform([['a', 'b', 'c']]), [('c', 'a')])
+
+    def test_transforms(self):
+        calls = []
+
+        def row_upper(value):
+            calls.append(value)
+            return value.upper()
+
+        mappings = [
+            {'csv_index': 0, 'transform': None},
+            {'csv_index': 0, 'transform': row_upper},
+            {'csv_index': 1, 'transform': transformations.sqlite_length}
+        ]
+
+        chunk_transform = libcsv2sqlite.compile_transform(mappings)
+        rows = chunk_transform(iter([['mary', 'abc'], ['john', 'de']]))
+
+        self.assertEqual(rows, [('mary', 'MARY', 3), ('john', 'JOHN', 2)])
+        self.assertEqual(calls, ['mary', 'john'])
+
+    def test_batch_transforms(self):
+        @transformations.batch(lambda values: [len(values)] * len(values))
+        def column_size(value):
+            raise AssertionError('row form should not be called')
+
+        mappings = [{'csv_index': 0, 'transform': column_size}]
+        chunk_transform = libcsv2sqlite.compile_transform(mappings)
+
+        self.assertEqual(chunk_transform([['a'], ['b']]), [(2,), (2,)])
+
+    def test_untransformed_columns(self):
+        # Text is bound as read, the column affinity converts numbers
+        mappings = [
+            {'csv_index': 0, 'transform': None, 'data_type': 'INTEGER'},
+            {'csv_index': 1, 'transform': None, 'data_type': 'REAL'}
+        ]
+
+        chunk_transform = libcsv2sqlite.compile_transform(mappings)
+
+        self.assertEqual(chunk_transform([['1', '2.5'], ['-3', 'x']]), [('1', '2.5'), ('-3', 'x')])
+
+
+class SchemaInferenceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.csv_path = 'tmp/test_inference.csv'
+
+        with open(cls.csv_path, 'w') as csv_file:
+            csv_file.write('number,flag,day,late\n')
+
+            for i in range(0, 6000):
+                late = 'text' if i == 5000 else str(i)
+                csv_file.write('{},{},2016-07-{:02},{}\n'.format(i, 'true' if i % 2 else 'false', i % 28 + 1, late))
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.csv_path)
+
+        if os.path.exists(inference.cache_path(cls.csv_path)):
+            os.remove(inference.cache_path(cls.csv_path))
+
+    def test_value_types(self):
+        self.assertEqual(inference.get_data_type(''), type(None))
+        self.assertEqual(inference.get_data_type('NULL'), type(None))
+        self.assertEqual(inference.get_data_type('True'), bool)
+        self.assertEqual(inference.get_data_type('2016-07-06'), datetime.date)
+        self.assertEqual(inference.get_data_type('2016-07-06T10:20:30Z'), datetime.datetime)
+
+    def test_empty_values(self):
+        engine = inference.SchemaInference()
+        engine.update_many([['1', ''], ['', ''], ['3', 'x']])
+
+        self.assertEqual(engine.types(), [int, str])
+
+    def test_head_and_full_samples(self):
+        headers = ['number', 'flag', 'day', 'late']
+        rows = libcsv2sqlite.csv_iter_file(self.csv_path, True)
+        next(rows)
+        sample = list(itertools.islice(rows, 1000))
+
+        head = libcsv2sqlite.sample_column_types(self.csv_path, True, headers, sample, 'head', 1000)
+        full = libcsv2sqlite.sample_column_types(self.csv_path, True, headers, sample, 'full', 1000)
+
+        self.assertEqual(head, ['INTEGER', 'BOOLEAN', 'DATE', 'INTEGER'])
+        self.assertEqual(full, ['INTEGER', 'BOOLEAN', 'DATE', 'TEXT'])
+
+    def test_schema_cache(self):
+        args = Objectifier({
+            'input': self.csv_path,
+            'mapping': '',
+            'output': 'tmp/test_inference.sqlite3',
+            'default_mapping_action': 'import',
+            'csv_has_title_columns': True,
+            'type_sample': 'full',
+            'schema_cache': True,
+        })
+
+        libcsv2sqlite.csv_to_sqlite3(args)
+        dbutils.connection.close()
+        dbutils.delete_database(args.output)
+
+        cached = inference.load_cached_types(self.csv_path, ['number', 'flag', 'day', 'late'])
+
+        self.assertEqual(cached, ['INTEGER', 'BOOLEAN', 'DATE', 'TEXT'])
+
+
+class MappingCacheTest(unittest.TestCase):
+    csv_path = 'tmp/mapping_cache.csv'
+    mapping_path = 'tmp/mapping_cache.json'
+    transformations_path = 'tmp/mapping_cache.py'
+
+    def setUp(self):
+        self.write_csv('name,city,amount')
+        self.write_transformations('value.upper()')
+
+        with open(self.mapping_path, 'w') as mapping_file:
+            json.dump({'transformations': 'mapping_cache.py', 'mappings': [
+                {'csv_index': 'name', 'transform': 'shout'},
+                {'csv_index': 'city', 'key': 'fk'},
+                {'csv_index': 2, 'column_name': 'amount'},
+            ]}, mapping_file)
+
+    def tearDown(self):
+        for path in [self.csv_path, self.mapping_path, self.transformations_path,
+                     mappingcache.cache_path(self.csv_path)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def write_csv(self, header):
+        with open(self.csv_path, 'w') as csv_file:
+            csv_file.write(header + '\nmary,lisbon,1.5\njohn,porto,2\n')
+
+    def write_transformations(self, expression):
+        with open(self.transformations_path, 'w') as transformations_file:
+            transformations_file.write('def shout(value):\n    return {}\n'.format(expression))
+
+    def run_import(self):
+        importer = libcsv2sqlite.Importer(Objectifier({
+            'input': self.csv_path,
+            'mapping': self.mapping_path,
+            'output': 'tmp/test_mapping_cache.sqlite3',
+            'default_mapping_action': 'ignore',
+            'csv_has_title_columns': True,
+            'mapping_cache': True,
+        }))
+        import_stats = importer.run()
+        rows = dbutils.select_all(importer.table_name, ['name', 'city_id', 'amount'], importer.connection)
+        types = dict((mapping['column_name'], mapping['data_type']) for mapping in importer.mappings)
+        importer.close()
+        dbutils.delete_database('tmp/test_mapping_cache.sqlite3')
+
+        return import_stats.counters.get('mapping_cache_hits', 0), rows, types
+
+    def test_cached_plan(self):
+        hits, rows, types = self.run_import()
+
+        self.assertEqual(hits, 0)
+        self.assertEqual(self.run_import(), (1, rows, types))
+        self.assertEqual([row['name'] for row in rows], ['MARY', 'JOHN'])
+        self.assertEqual(types, {'name': 'TEXT', 'city': 'TEXT', 'amount': 'REAL'})
+
+    def test_invalidation(self):
+        self.run_import()
+
+        self.write_transformations('value.lower()')
+        hits, rows, types = self.run_import()
+
+        self.assertEqual(hits, 0)
+        self.assertEqual(rows[0]['name'], 'mary')
+
+        self.write_csv('name,city,total')
+        self.assertEqual(self.run_import()[0], 0)
+
+        with open(self.mapping_path, 'w') as mapping_file:
+            json.dump({'mappings': [{'csv_index': 'name'}, {'csv_index': 'city', 'key': 'fk'},
+                                    {'csv_index': 2, 'column_name': 'amount'}]}, mapping_file)
+
+        self.assertEqual(self.run_import()[0], 0)
+        self.assertEqual(self.run_import()[0], 1)
+
+
+class BenchmarkGeneratorTest(unittest.TestCase):
+    def test_deterministic_csv(self):
+        settings = benchmark.scenario_settings('quoted')
+        settings['rows'] = 50
+
+        contents = []
+
+        for path in ['tmp/benchmark_a.csv', 'tmp/benchmark_b.csv']:
+            benchmark.generate_csv(path, settings)
+
+            with open(path) as csv_file:
+                contents.append(csv_file.read())
+
+            os.remove(path)
+
+        self.assertEqual(contents[0], contents[1])
+        self.assertIn('"', contents[0])
+
+    def test_column_kinds(self):
+        settings = benchmark.scenario_settings('fk_heavy')
+
+        kinds = benchmark.column_kinds(settings)
+
+        self.assertEqual(len(kinds), settings['columns'])
+        self.assertEqual(kinds[:4], ['fk'] * 4)
+
+
 class DuplicateMappingColumnNameTest(unittest.TestCase):
     def test_duplicates(self):
         mappings = [
@@ -1,10 +1,21 @@
 import random
 
 
+def batch(batch_function):
+    # Declares a faster form of a transformation that maps a whole column
+    def decorator(function):
+        function.batch = batch_function
+        return function
+
+    return decorator
+
+
+@batch(lambda values: list(map(str.upper, values)))
 def sqlite_upper(input):
     return input.upper()
 
 
+@batch(lambda values: list(map(str.lower, values)))
 def sqlite_lower(input):
     return input.lower()
 
@@ -13,18 +24,22 @@ def sqlite_abs(input):
     return abs(input)
 
 
+@batch(lambda values: list(map(len, values)))
 def sqlite_length(input):
     return len(input)
 
 
+@batch(lambda values: list(map(str.lstrip, map(str, values))))
 def sqlite_ltrim(input):
     return str(input).lstrip()
 
 
+@batch(lambda values: list(map(str.rstrip, map(str, values))))
 def sqlite_rtrim(input):
     return str(input).rstrip()
 
 
+@batch(lambda values: list(map(str.strip, map(str, values))))
 def sqlite_trim(input):
     return str(input).strip()
 